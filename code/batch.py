@@ -0,0 +1,432 @@
+#
+# This file contains the batched version of Hugin propagation: the same JunctionTree is propagated once for many
+# cases, each with its own evidence, by giving every table a leading axis with an entry for each case
+#
+import itertools
+import multiprocessing
+import os
+from collections import deque
+from multiprocessing import shared_memory
+
+import numpy as np
+
+import util
+
+
+class BatchJunctionTree(object):
+    """
+    Inference engine that runs a JunctionTree on many cases at once. Every clique and separator table has a leading
+    batch axis, evidence is entered for all the cases with a single multiplication for each clique and each absorption
+    of CollectEvidence and DistributeEvidence is executed once for the whole batch
+    """
+
+    def __init__(self, jtree, batch_size=1024, root=None):
+        """
+        Builds the batched tables from the calibrated tables without evidence of an initialized JunctionTree, the
+        JunctionTree is reset to them
+
+        :type jtree: JunctionTree
+        :param batch_size: maximum number of cases propagated together, the batched tables take batch_size times the
+        memory of the tables of jtree
+        :type batch_size: int
+        :param root: clique to use as root, if it's not given it's chosen by JunctionTree.get_best_root
+        :type root: Node
+        """
+        if batch_size < 1:
+            raise AttributeError("The batch size must be positive")
+        jtree.reset()
+
+        self._jtree = jtree
+        self._batch_size = batch_size
+        self._root = jtree.get_best_root() if root is None else root
+        self._schedule = jtree.get_propagation_schedule(self._root)
+
+        cliques, separators = jtree.get_cliques_and_seps()
+        nodes = cliques + separators
+
+        """
+        Variables of the table of each node, in the order of its axes
+        """
+        self._node_vars = {node: list(node.get_variables()) for node in nodes}
+
+        """
+        Tables of all nodes, one after the other, without evidence. They are copied in the batched tables for each
+        case before propagating
+        """
+        self._prior = np.concatenate([node.get_prob_table().get_prob(Ellipsis).ravel() for node in nodes])
+
+        """
+        Buffer that holds the batched tables, a row for each case, and the view of it for each node. They are allocated
+        by the first inference
+        """
+        self._arena = None
+        self._tables = {}
+
+        """
+        Plans of the absorptions of the schedule, toward the root for CollectEvidence and away from it for
+        DistributeEvidence
+        """
+        self._collect_plan = [self._build_absorption_plan(child, separator, parent)
+                              for parent, separator, child in reversed(self._schedule)]
+        self._distribute_plan = [self._build_absorption_plan(parent, separator, child)
+                                 for parent, separator, child in self._schedule]
+
+        """
+        P(e) of each case of the last inference
+        """
+        self._evidence_prob = None
+
+    def _ensure_arena(self):
+        """
+        Allocates the buffer of the batched tables if it wasn't already
+
+        :return: None
+        """
+        if self._arena is not None:
+            return
+
+        self._arena = np.empty((self._batch_size, self._prior.size))
+        offset = 0
+        for node, variables in self._node_vars.items():
+            size = int(np.prod([el.get_cardinality() for el in variables], dtype=int))
+            shape = (self._batch_size,) + tuple(el.get_cardinality() for el in variables)
+            self._tables[node] = self._arena[:, offset:offset + size].reshape(shape)
+            offset += size
+
+    def _build_absorption_plan(self, first, separator, second):
+        """
+        Computes how the batched tables are transformed when second absorbs from first: the axes of first to sum
+        over, the permutation that sorts the remaining axes like the separator and how the separator is aligned to
+        second. Axis 0 is always the batch axis
+
+        :type first: Node
+        :type separator: Node
+        :type second: Node
+        :rtype: tuple
+        """
+        first_vars = self._node_vars[first]
+        separator_vars = self._node_vars[separator]
+        second_vars = self._node_vars[second]
+
+        sum_axes = tuple(i + 1 for i, el in enumerate(first_vars) if el not in separator_vars)
+        remaining_vars = [el for el in first_vars if el in separator_vars]
+        permutation = [0] + [remaining_vars.index(el) + 1 for el in separator_vars]
+
+        alignment = [0] + [separator_vars.index(el) + 1 for el in second_vars if el in separator_vars]
+        aligned_shape = (-1,) + tuple(el.get_cardinality() if el in separator_vars else 1 for el in second_vars)
+
+        return first, separator, second, sum_axes, permutation, alignment, aligned_shape
+
+    def get_likelihoods(self, cases):
+        """
+        Converts the evidence of a list of cases in a likelihood for each observed variable, with a row for each case.
+        Each case maps the names of the observed variables to their value, or to the weights of their values for
+        likelihood evidence. Variables that are not observed in a case have all weights equal to 1
+
+        :type cases: list[dict[str,int or str or list[float]]]
+        :rtype: dict[Variable,np.ndarray]
+        """
+        likelihoods = {}
+        for i, case in enumerate(cases):
+            for name, value in case.items():
+                variable = self._jtree.get_variable_by_name(name)
+                if variable not in likelihoods:
+                    likelihoods[variable] = np.ones((len(cases), variable.get_cardinality()))
+
+                if isinstance(value, (list, np.ndarray)):
+                    weights = np.asarray(value, dtype=float)
+                    if weights.shape != (variable.get_cardinality(),) or np.any(weights < 0):
+                        raise AttributeError("The likelihood must have a non negative weight for each value of the "
+                                             "variable")
+                    likelihoods[variable][i] = weights
+                else:
+                    likelihoods[variable][i] = 0
+                    likelihoods[variable][i, variable.get_value_index(value)] = 1
+
+        return likelihoods
+
+    def infer(self, cases, variables=None):
+        """
+        Computes the probabilities of the given variables for each case of a list, see get_likelihoods for the format
+        of the cases. The cases are propagated batch_size at a time.
+        Returns each variable mapped to an array with a row for each case and a column for each value of the variable,
+        the rows of cases whose evidence is conflicting are NaN
+
+        :type cases: list[dict[str,int or str or list[float]]]
+        :param variables: names of the variables to compute, all variables if not given
+        :type variables: list[str]
+        :rtype: dict[str,np.ndarray]
+        """
+        return self._infer(self.get_likelihoods(cases), len(cases), variables)
+
+    def infer_likelihoods(self, likelihoods, variables=None):
+        """
+        Same as infer, but the evidence is given as an array of likelihoods for each observed variable, with a row for
+        each case and a column for each value of the variable. Hard evidence has a single 1 in each row
+
+        :type likelihoods: dict[str or Variable,np.ndarray]
+        :param variables: names of the variables to compute, all variables if not given
+        :type variables: list[str]
+        :rtype: dict[str,np.ndarray]
+        """
+        if len(likelihoods) == 0:
+            raise AttributeError("At least a variable has to be observed")
+
+        checked = {}
+        for variable, likelihood in likelihoods.items():
+            if isinstance(variable, str):
+                variable = self._jtree.get_variable_by_name(variable)
+            likelihood = np.asarray(likelihood, dtype=float)
+            if likelihood.ndim != 2 or likelihood.shape[1] != variable.get_cardinality() or np.any(likelihood < 0):
+                raise AttributeError("The likelihood must have a non negative weight for each case and each value of "
+                                     "the variable")
+            checked[variable] = likelihood
+
+        n_cases = {len(el) for el in checked.values()}
+        if len(n_cases) != 1:
+            raise AttributeError("All likelihoods must have the same number of cases")
+
+        return self._infer(checked, n_cases.pop(), variables)
+
+    def get_evidence_probability(self):
+        """
+        Returns P(e) for each case of the last inference, 0 for the cases whose evidence is conflicting
+
+        :rtype: np.ndarray
+        """
+        return self._evidence_prob
+
+    def _infer(self, likelihoods, n_cases, variables):
+        """
+        Propagates the likelihoods batch_size cases at a time and collects the results
+
+        :type likelihoods: dict[Variable,np.ndarray]
+        :type n_cases: int
+        :type variables: list[str]
+        :rtype: dict[str,np.ndarray]
+        """
+        if variables is None:
+            variables = list(self._jtree.get_variables())
+        else:
+            variables = [self._jtree.get_variable_by_name(name) for name in variables]
+
+        results = {variable.name: np.empty((n_cases, variable.get_cardinality())) for variable in variables}
+        self._evidence_prob = np.empty(n_cases)
+
+        for start in range(0, n_cases, self._batch_size):
+            end = min(start + self._batch_size, n_cases)
+            self._propagate({variable: el[start:end] for variable, el in likelihoods.items()}, end - start)
+
+            self._evidence_prob[start:end] = self._get_root_total(end - start)
+            for variable in variables:
+                results[variable.name][start:end] = self._get_marginal(variable, end - start)
+
+        return results
+
+    def _propagate(self, likelihoods, n):
+        """
+        Resets the first n rows of the batched tables, enters the likelihoods and runs CollectEvidence and
+        DistributeEvidence on them
+
+        :type likelihoods: dict[Variable,np.ndarray]
+        :type n: int
+        :return: None
+        """
+        self._ensure_arena()
+        self._arena[:n] = self._prior
+
+        # Enter the evidence, the mask of each clique is the product of the likelihoods of its observed variables
+        masks = {}
+        for variable, likelihood in likelihoods.items():
+            clique = self._jtree.get_chosen_clique(variable)
+            shape = (n,) + tuple(el.get_cardinality() if el == variable else 1 for el in self._node_vars[clique])
+            factor = likelihood.reshape(shape)
+            masks[clique] = factor if clique not in masks else masks[clique] * factor
+
+        if len(masks) == 0:
+            return
+
+        received_evidence = dict.fromkeys(masks, True)
+        for clique, mask in masks.items():
+            self._tables[clique][:n] *= mask
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            # Like JunctionTree.collect_evidence, only subtrees with evidence send their messages
+            for plan in self._collect_plan:
+                first, _, second = plan[:3]
+                if first in received_evidence:
+                    self._absorb(plan, n)
+                    received_evidence[second] = True
+
+            for plan in self._distribute_plan:
+                self._absorb(plan, n)
+
+    def _absorb(self, plan, n):
+        """
+        Batched absorption on the first n rows of the tables, following a plan built by _build_absorption_plan
+
+        :type plan: tuple
+        :type n: int
+        :return: None
+        """
+        first, separator, second, sum_axes, permutation, alignment, aligned_shape = plan
+        separator_table = self._tables[separator][:n]
+
+        ts_star = np.transpose(np.sum(self._tables[first][:n], axis=sum_axes), permutation)
+
+        # 0/0 gives 0 like BeliefTable.divide_table
+        update = np.zeros(ts_star.shape)
+        np.divide(ts_star, separator_table, out=update, where=(ts_star != 0))
+        separator_table[...] = ts_star
+
+        self._tables[second][:n] *= np.transpose(update, alignment).reshape(aligned_shape)
+
+    def _get_root_total(self, n):
+        """
+        Returns the sum of the table of the root for each of the first n cases, that is P(e) since the tables without
+        evidence are normalized
+
+        :type n: int
+        :rtype: np.ndarray
+        """
+        return np.sum(self._tables[self._root][:n].reshape(n, -1), axis=1)
+
+    def _get_marginal(self, variable, n):
+        """
+        Returns the normalized probabilities of the variable for each of the first n cases, NaN for the cases with a
+        table of zeros
+
+        :type variable: Variable
+        :type n: int
+        :rtype: np.ndarray
+        """
+        clique = self._jtree.get_chosen_clique(variable)
+        axis = self._node_vars[clique].index(variable) + 1
+        sum_axes = tuple(i for i in range(1, len(self._node_vars[clique]) + 1) if i != axis)
+
+        marginal = np.sum(self._tables[clique][:n], axis=sum_axes)
+        total = np.sum(marginal, axis=1, keepdims=True)
+
+        result = np.full(marginal.shape, np.nan)
+        np.divide(marginal, total, out=result, where=(total != 0))
+        return result
+
+
+"""
+Engine used by the worker processes of batch_infer, inherited from the process that creates them
+"""
+_worker_engine = None
+
+"""
+Shared memory that holds the prior tables in a worker process, referenced so that it stays attached
+"""
+_worker_memory = None
+
+
+def batch_infer(model_path, cases, variables=None, workers=None, batch_size=1024):
+    """
+    Loads a model and computes the probabilities of the given variables for each case, with a pool of worker
+    processes. The model is loaded and initialized once, its calibrated tables without evidence are placed in shared
+    memory and every worker attaches to them without copying, so only the batched tables are allocated by each worker.
+    The workers are forked, with a single worker everything runs in this process.
+    The results are yielded as soon as they're ready, in the order of the cases: for each case the variables mapped to
+    their probabilities and P(e), see BatchJunctionTree.infer. Cases are read at most two chunks for each worker ahead
+    of the results
+
+    :param model_path: file with a bayesian net and its junction tree, see util.load_model
+    :type model_path: str
+    :param cases: each case maps the names of the observed variables to their value, or to the weights of their values
+    :type cases: collections.abc.Iterable[dict[str,int or str or list[float]]]
+    :param variables: names of the variables to compute, all variables if not given
+    :type variables: list[str]
+    :param workers: number of worker processes, the number of cpus if not given
+    :type workers: int
+    :param batch_size: number of cases propagated together by a worker
+    :type batch_size: int
+    :rtype: collections.abc.Iterator[tuple[dict[str,np.ndarray],float]]
+    """
+    global _worker_engine
+
+    net, jtree = util.load_model(model_path)
+    jtree.initialize_tables(net)
+    engine = BatchJunctionTree(jtree, batch_size)
+
+    cases = iter(cases)
+    chunks = iter(lambda: list(itertools.islice(cases, batch_size)), [])
+
+    if workers is None:
+        workers = os.cpu_count()
+    if workers <= 1:
+        for chunk in chunks:
+            yield from _split_results(engine.infer(chunk, variables), engine.get_evidence_probability())
+        return
+
+    # The prior tables are moved in shared memory before forking, so that the workers don't get a private copy
+    size = engine._prior.size
+    memory = shared_memory.SharedMemory(create=True, size=engine._prior.nbytes)
+    pool = None
+    try:
+        shared_prior = np.ndarray((size,), buffer=memory.buf)
+        shared_prior[...] = engine._prior
+        engine._prior = None
+        del shared_prior
+
+        _worker_engine = engine
+        pool = multiprocessing.get_context('fork').Pool(workers, _init_worker, (memory.name, size))
+
+        # At most two chunks for each worker are read and sent ahead of the results, so the memory used doesn't grow
+        # with the number of cases. A new chunk is sent as soon as the oldest one is done
+        pending = deque(pool.apply_async(_infer_chunk, ((chunk, variables),))
+                        for chunk in itertools.islice(chunks, 2 * workers))
+        while len(pending) != 0:
+            result, evidence_prob = pending.popleft().get()
+            for chunk in itertools.islice(chunks, 1):
+                pending.append(pool.apply_async(_infer_chunk, ((chunk, variables),)))
+            yield from _split_results(result, evidence_prob)
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+        _worker_engine = None
+        memory.close()
+        memory.unlink()
+
+
+def _init_worker(memory_name, size):
+    """
+    Attaches a worker process to the prior tables in shared memory
+
+    :param memory_name: name of the shared memory
+    :type memory_name: str
+    :param size: number of entries of the prior tables
+    :type size: int
+    :return: None
+    """
+    global _worker_memory
+
+    _worker_memory = shared_memory.SharedMemory(name=memory_name)
+    _worker_engine._prior = np.ndarray((size,), buffer=_worker_memory.buf)
+
+
+def _infer_chunk(task):
+    """
+    Runs the engine of the worker on a chunk of cases
+
+    :param task: the cases and the names of the variables to compute
+    :type task: tuple[list[dict],list[str]]
+    :rtype: tuple[dict[str,np.ndarray],np.ndarray]
+    """
+    chunk, variables = task
+    return _worker_engine.infer(chunk, variables), _worker_engine.get_evidence_probability()
+
+
+def _split_results(result, evidence_prob):
+    """
+    Splits the results of a chunk of cases in the results of each case
+
+    :type result: dict[str,np.ndarray]
+    :type evidence_prob: np.ndarray
+    :rtype: collections.abc.Iterator[tuple[dict[str,np.ndarray],float]]
+    """
+    for i in range(len(evidence_prob)):
+        yield {name: el[i] for name, el in result.items()}, float(evidence_prob[i])
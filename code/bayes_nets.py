@@ -2,10 +2,16 @@
 # This file contains the data structures used to represent and work on bayesian nets
 #
 import copy
+import hashlib
+import weakref
 from collections import Counter
+from collections import OrderedDict
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 
+import triangulation
 import util
 from tables import BeliefTable
 from tables import Variable
@@ -34,6 +40,52 @@ class BayesianNet(object):
         """
         self._tables = {}
 
+        """
+        Dictionary that maps the name of each variable to the variable, used for lookups by name
+        """
+        self._variables_by_name = {var.name: var for var in self._graph}
+
+        """
+        Reverse adjacency of the graph: each variable mapped to the list of its fathers
+        """
+        self._parents = {}
+
+        """
+        Position of each variable in a topological order of the graph(fathers come before their children), kept
+        updated by add_dependence. The sorted list of variables is only rebuilt when requested.
+        """
+        self._order_index = {}
+        self._topological_order = None
+
+        self._build_parents()
+
+    def _build_parents(self):
+        """
+        Builds the reverse adjacency and a topological order of the graph (Kahn's algorithm)
+
+        :return: None
+        """
+        self._parents = {var: [] for var in self._graph}
+        for father, children in self._graph.items():
+            for child in children:
+                if father not in self._parents[child]:
+                    self._parents[child].append(father)
+
+        missing_fathers = {var: len(fathers) for var, fathers in self._parents.items()}
+        queue = [var for var, count in missing_fathers.items() if count == 0]
+        self._order_index = {}
+        while len(queue) != 0:
+            var = queue.pop()
+            self._order_index[var] = len(self._order_index)
+            for child in self._graph[var]:
+                missing_fathers[child] -= 1
+                if missing_fathers[child] == 0:
+                    queue.append(child)
+
+        if len(self._order_index) != len(self._graph):
+            raise AttributeError("The graph of the bayesian net contains a cycle")
+        self._topological_order = None
+
     def add_variable(self, new_variable):
         """
         Add the given variable to the BN
@@ -46,6 +98,12 @@ class BayesianNet(object):
         else:
             self._graph[new_variable] = []
             self._tables[new_variable] = None
+            self._variables_by_name[new_variable.name] = new_variable
+
+            # A variable without fathers can go after all the others
+            self._parents[new_variable] = []
+            self._order_index[new_variable] = len(self._order_index)
+            self._topological_order = None
 
     def add_dependence(self, child, father):
         """
@@ -64,8 +122,77 @@ class BayesianNet(object):
             raise AttributeError("Invalid father")
         elif child not in self._graph.keys():
             raise AttributeError("Invalid child")
-        else:
+        elif father not in self._parents[child]:
+            self._update_topological_order(child, father)
             self._graph[father].append(child)
+            self._parents[child].append(father)
+
+    def _update_topological_order(self, child, father):
+        """
+        Updates the topological order before the link father->child is added, raises an error if the link would create
+        a cycle. Only the variables between the two in the current order are visited and moved (Pearce-Kelly)
+
+        :type child: Variable
+        :type father: Variable
+        :return: None
+        """
+        lower_bound = self._order_index[child]
+        upper_bound = self._order_index[father]
+        if lower_bound > upper_bound:
+            # The order is still valid
+            return
+        if child == father:
+            raise AttributeError("A variable can't depend on itself")
+
+        # Variables reachable from the child that come before the father: if the father is one of them there's a cycle
+        forward = self._bounded_search(child, self._graph, lambda pos: pos <= upper_bound)
+        if father in forward:
+            raise AttributeError("The dependence would create a cycle")
+
+        # Variables that reach the father and come after the child
+        backward = self._bounded_search(father, self._parents, lambda pos: pos >= lower_bound)
+
+        # Move the ancestors of the father before the descendants of the child, reusing the same positions
+        backward.sort(key=self._order_index.get)
+        forward.sort(key=self._order_index.get)
+        positions = sorted(self._order_index[var] for var in backward + forward)
+        for var, pos in zip(backward + forward, positions):
+            self._order_index[var] = pos
+
+        self._topological_order = None
+
+    def _bounded_search(self, start, adjacency, is_in_bounds):
+        """
+        Depth first search from start over the given adjacency, visiting only variables whose position in the
+        topological order is in bounds
+
+        :type start: Variable
+        :type adjacency: dict[Variable,list[Variable]]
+        :param is_in_bounds: function of the position of a variable
+        :type is_in_bounds: function
+        :return: visited variables
+        :rtype: list[Variable]
+        """
+        visited = {start: None}
+        stack = [start]
+        while len(stack) != 0:
+            var = stack.pop()
+            for neighbour in adjacency[var]:
+                if neighbour not in visited and is_in_bounds(self._order_index[neighbour]):
+                    visited[neighbour] = None
+                    stack.append(neighbour)
+
+        return list(visited)
+
+    def get_topological_order(self):
+        """
+        Returns the variables of the net sorted so that each variable comes after all its fathers
+
+        :rtype: list[Variable]
+        """
+        if self._topological_order is None:
+            self._topological_order = sorted(self._graph, key=self._order_index.get)
+        return list(self._topological_order)
 
     def add_prob_table(self, variable, table):
         """
@@ -109,12 +236,25 @@ class BayesianNet(object):
         if child not in self._graph.keys():
             raise AttributeError("Child not found")
 
-        fathers = []
-        for el in self._graph:
-            if child in self._graph[el]:
-                fathers.append(el)
+        return list(self._parents[child])
+
+    def get_moral_graph(self):
+        """
+        Returns the moral graph of the net: the undirected graph where each variable is linked to its fathers, its
+        children and the other fathers of its children
 
-        return fathers
+        :return: each variable mapped to the set of its neighbours
+        :rtype: dict[Variable,set[Variable]]
+        """
+        moral_graph = {var: set() for var in self._graph}
+
+        for child, fathers in self._parents.items():
+            family = fathers + [child]
+            for el in family:
+                moral_graph[el].update(family)
+                moral_graph[el].discard(el)
+
+        return moral_graph
 
     def get_U_probability_string(self):
         """
@@ -147,11 +287,9 @@ class BayesianNet(object):
         :type name: str
         :rtype: Variable
         """
-        for var in self._tables.keys():
-            if var.name == name:
-                return var
-
-        raise AttributeError("Variable not found")
+        if name not in self._variables_by_name:
+            raise AttributeError("Variable not found")
+        return self._variables_by_name[name]
 
     def get_variables(self):
         """
@@ -182,6 +320,15 @@ class BayesianNet(object):
         rstring = rstring[:-2] + "\n}"
         return rstring
 
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+
+        # Nets saved before the indexes were introduced have to build them
+        if '_variables_by_name' not in state:
+            self._variables_by_name = {var.name: var for var in self._graph}
+        if '_parents' not in state:
+            self._build_parents()
+
 
 class JunctionTree(object):
     """
@@ -213,6 +360,167 @@ class JunctionTree(object):
         """
         self._chosen_clique = {}
 
+        """
+        Indexes used for lookups: the name of each variable mapped to the variable, the set of variables of each clique
+        mapped to the clique and the set of variables of each separator mapped to the separators made up of them
+        """
+        self._variables_by_name = {}
+        self._clique_index = {}
+        self._separator_index = {}
+        self._build_indexes()
+
+        """
+        Propagation schedules compiled for each root, see get_propagation_schedule and get_propagation_levels, the
+        best root for each criterion, see get_best_root, the clique used to query each variable, see query, and the
+        plan of the absorption along each edge in each direction, see _get_absorption_plan. They only depend on the
+        structure of the tree
+        """
+        self._schedules = {}
+        self._levels = {}
+        self._best_roots = {}
+        self._query_cliques = {}
+        self._absorption_plans = {}
+
+        """
+        Contiguous buffer that holds the tables of all cliques and separators, which are views of it, and the tables
+        that were laid out in it. Built by _ensure_arena
+        """
+        self._arena = None
+        self._arena_tables = None
+
+        """
+        Snapshot of the calibrated tables without evidence, taken by initialize_tables and restored by reset, and the
+        identifier of the model computed from them, see get_model_id
+        """
+        self._prior = None
+        self._model_id = None
+
+        """
+        Evidence entered since the tables were initialized, each variable is mapped to its likelihood, hard evidence
+        being a likelihood that is 1 for the observed value and 0 for the others
+        """
+        self._evidence = {}
+
+        """
+        Probability of the evidence entered, the product of all the normalization constants since the tables were
+        initialized
+        """
+        self._evidence_prob = 1.0
+
+        """
+        Thread pool used by sum_propagate with more than one worker and its number of workers, kept between
+        propagations and only created again when the number of workers changes
+        """
+        self._executor = None
+        self._executor_workers = None
+
+    def _structure_changed(self):
+        """
+        Forgets everything that was computed from the structure of the tree
+
+        :return: None
+        """
+        self._schedules = {}
+        self._levels = {}
+        self._best_roots = {}
+        self._query_cliques = {}
+        self._absorption_plans = {}
+        self._arena = None
+        self._arena_tables = None
+        self._prior = None
+        self._model_id = None
+
+    def _ensure_arena(self):
+        """
+        Lays out the tables of all cliques and separators in a single contiguous buffer, unless they already are.
+        Each table keeps its entries and becomes a view of the buffer with its variables sorted
+
+        :return: None
+        """
+        nodes = self._cliques + self._separators
+        if (self._arena_tables is not None and len(self._arena_tables) == len(nodes)
+                and all(node.get_prob_table() is table for node, table in zip(nodes, self._arena_tables))):
+            return
+
+        sizes = [node.get_prob_table().get_vars_size() for node in nodes]
+        arena = np.empty(sum(sizes))
+        arena_tables = []
+
+        offset = 0
+        for node, size in zip(nodes, sizes):
+            variables = sorted(node.get_variables())
+            view = arena[offset:offset + size].reshape(util.get_shape_from_var_dict(variables))
+            table = BeliefTable(variables, view)
+            table.copy_table_from(node.get_prob_table())
+
+            node.set_prob_table(table)
+            arena_tables.append(table)
+            offset += size
+
+        self._arena = arena
+        self._arena_tables = arena_tables
+
+    def _build_indexes(self):
+        """
+        Builds the lookup indexes from the variables, cliques and separators of the JunctionTree
+
+        :return: None
+        """
+        self._variables_by_name = {var.name: var for var in self._variables}
+
+        self._clique_index = {}
+        for clique in self._cliques:
+            self._clique_index.setdefault(frozenset(clique.get_variables()), clique)
+
+        self._separator_index = {}
+        for sep in self._separators:
+            self._separator_index.setdefault(frozenset(sep.get_variables()), []).append(sep)
+
+    def _is_clique(self, node):
+        """
+        Checks if the given Node is one of the cliques of the JunctionTree
+
+        :type node: Node
+        :rtype: bool
+        """
+        return self._clique_index.get(frozenset(node.get_variables())) is node
+
+    def _is_separator(self, node):
+        """
+        Checks if the given Node is one of the separators of the JunctionTree
+
+        :type node: Node
+        :rtype: bool
+        """
+        return any(sep is node for sep in self._separator_index.get(frozenset(node.get_variables()), []))
+
+    @staticmethod
+    def compile(bayes_net, heuristic='min_fill', order=None):
+        """
+        Builds the JunctionTree of a BayesianNet: the moral graph of the net is triangulated by eliminating its
+        variables, the maximal cliques of the triangulated graph become the cliques of the tree and they are connected
+        by a maximum weight spanning tree, where the weight of a link is the size of its separator.
+        The resulting tree still has to be initialized with initialize_tables
+
+        :type bayes_net: BayesianNet
+        :param heuristic: used to choose the elimination order: 'min_fill', 'min_weight' or 'min_degree'
+        :type heuristic: str
+        :param order: elimination order to use instead of the heuristic
+        :type order: list[Variable]
+        :rtype: JunctionTree
+        """
+        cliques, connections = triangulation.triangulate(bayes_net.get_moral_graph(), heuristic, order)
+
+        jtree = JunctionTree(bayes_net.get_variables())
+        for clique in cliques:
+            jtree.add_clique(clique)
+
+        for clique1, clique2 in connections:
+            # Parts of the net that are not connected are linked by an empty separator
+            jtree.connect_cliques(clique1, clique2, allow_empty=True)
+
+        return jtree
+
     def add_clique(self, clique):
         """
         Add a valid clique made up of variables to the list of cliques
@@ -229,6 +537,8 @@ class JunctionTree(object):
             raise AttributeError("The given clique is not valid for the junction tree")
         new_node = Node(BeliefTable(clique))
         self._cliques.append(new_node)
+        self._clique_index.setdefault(frozenset(clique), new_node)
+        self._structure_changed()
 
     def add_separator(self, separator):
         """
@@ -236,7 +546,8 @@ class JunctionTree(object):
         Variables can be both list/dict of references or a list of variable names
 
         :type separator: list[str] or dict[Variable,None] or list[Variable]
-        :return: None
+        :return: the new separator
+        :rtype: Node
         """
         if all(isinstance(x, str) for x in separator):
             separator = [self.get_variable_by_name(name) for name in separator]
@@ -246,6 +557,10 @@ class JunctionTree(object):
             raise AttributeError("The given separator is not valid for the junction tree")
         new_node = Node(BeliefTable(separator))
         self._separators.append(new_node)
+        self._separator_index.setdefault(frozenset(separator), []).append(new_node)
+        self._structure_changed()
+
+        return new_node
 
     def add_link(self, clique, separator):
         """
@@ -272,20 +587,24 @@ class JunctionTree(object):
         :type separator: Node
         :return: None
         """
-        if clique not in self._cliques or separator not in self._separators:
+        if not self._is_clique(clique) or not self._is_separator(separator):
             raise AttributeError("Clique or separator not valid for the junction tree")
         if not(separator.get_variables().keys() <= clique.get_variables().keys()):
             raise AttributeError("Clique does not contain the variables in the separator")
 
         clique.add_neighbour(separator)
         separator.add_neighbour(clique)
+        self._structure_changed()
 
-    def connect_cliques(self, clique1, clique2):
+    def connect_cliques(self, clique1, clique2, allow_empty=False):
         """
         Connect two neighbouring cliques by creating a separator between them and linking them all
 
         :type clique1: list[str] or list[Variable]
         :param clique2: list[str] or list[Variable]
+        :param allow_empty: whether cliques without common variables can be connected by an empty separator, as the
+        parts of a bayesian net that are not connected
+        :type allow_empty: bool
         :return:
         """
         if all(isinstance(x, str) for x in clique1):
@@ -293,17 +612,19 @@ class JunctionTree(object):
         if all(isinstance(x, str) for x in clique2):
             clique2 = [self.get_variable_by_name(name) for name in clique2]
 
-        clique_variables_list = [node.get_variables() for node in self._cliques]
-        if dict.fromkeys(clique1) not in clique_variables_list or dict.fromkeys(clique2) not in clique_variables_list:
+        true_clique1 = self.get_clique_from_dict(clique1)
+        true_clique2 = self.get_clique_from_dict(clique2)
+        if true_clique1 is None or true_clique2 is None:
             raise AttributeError("One of the cliques wasn't valid")
 
         common_vars = [var for var in clique1 if var in clique2]
-        if len(common_vars) == 0:
+        if len(common_vars) == 0 and not allow_empty:
             raise AttributeError("The cliques aren't neighbouring")
 
-        self.add_separator(common_vars)
-        self.add_link(clique1, common_vars)
-        self.add_link(clique2, common_vars)
+        # Link the new separator directly, other separators might be made up of the same variables
+        separator = self.add_separator(common_vars)
+        self._add_link(true_clique1, separator)
+        self._add_link(true_clique2, separator)
 
     def set_variable_chosen_clique(self, variable, clique):
         """
@@ -332,7 +653,7 @@ class JunctionTree(object):
         if variable not in self._variables.keys():
             raise AttributeError("Variable not valid")
 
-        if clique not in self._cliques:
+        if not self._is_clique(clique):
             raise AttributeError("Clique not valid")
 
         self._chosen_clique[variable] = clique
@@ -348,13 +669,10 @@ class JunctionTree(object):
         if all(isinstance(x, str) for x in clique_vars):
             clique_vars = [self.get_variable_by_name(name) for name in clique_vars]
 
-        dict_clique = dict.fromkeys(clique_vars)
-
-        for clique in self._cliques:
-            if clique.get_variables() == dict_clique:
-                return clique
-
-        raise AttributeError("Clique not valid")
+        clique = self._clique_index.get(frozenset(clique_vars))
+        if clique is None:
+            raise AttributeError("Clique not valid")
+        return clique
 
     def get_separator(self, separator_vars):
         """
@@ -367,18 +685,15 @@ class JunctionTree(object):
         if all(isinstance(x, str) for x in separator_vars):
             separator_vars = [self.get_variable_by_name(name) for name in separator_vars]
 
-        dict_sep = dict.fromkeys(separator_vars)
-
-        for sep in self._separators:
-            if sep.get_variables() == dict_sep:
-                return sep
-
-        raise AttributeError("Separator not valid")
+        separators = self._separator_index.get(frozenset(separator_vars))
+        if separators is None:
+            raise AttributeError("Separator not valid")
+        return separators[0]
 
     def add_evidence(self, variable, value):
         """
         Add evidence to a variable in the JunctionTree by setting the table of the relative clique to the correct
-        configuration(according to evidence)
+        configuration(according to evidence), that is a likelihood that is 1 for the observed value and 0 for the others
 
         :type variable: Variable or str
         :param value: evidence to assert, can only be a correct value according to the variable
@@ -387,38 +702,233 @@ class JunctionTree(object):
         """
         if isinstance(variable, str):
             variable = self.get_variable_by_name(variable)
-        if isinstance(value, str):
-            value = value.lower()
 
+        self.add_likelihood(variable, self._get_indicator(variable, value))
+
+    def add_likelihood(self, variable, likelihood):
+        """
+        Add likelihood(soft) evidence to a variable: the table of the relative clique is multiplied along the axis of
+        the variable by a weight for each value of the variable, in the order of its values.
+        e.g. [0.8, 0.2] on a binary variable means that the observation is 4 times more likely if the variable takes its
+        first value. Likelihoods entered on the same variable are multiplied
+
+        :type variable: Variable or str
+        :param likelihood: non negative weight of each value of the variable
+        :type likelihood: list[float] or np.ndarray
+        :return: None
+        """
+        if isinstance(variable, str):
+            variable = self.get_variable_by_name(variable)
         if variable not in self._variables:
             raise AttributeError("Variable not valid")
-        if not variable.is_valid(value):
-            raise AttributeError("Value not valid")
+        likelihood = self._check_likelihood(variable, likelihood)
 
-        # Find the clique to update
+        # Find the clique to update, its table is updated in place
+        self._ensure_arena()
         chosen_clique = self._chosen_clique[variable]
+        table = chosen_clique.get_prob_table()
+
+        # P(e) = sum_x P(x)L(x), checked before touching the table so that conflicting evidence leaves it as it was
+        evidence_prob = np.dot(table.marginalize([variable]).get_prob(Ellipsis), likelihood)
+        if evidence_prob == 0:
+            raise RuntimeError("Conflicting evidence was entered")
+
         chosen_clique.received_evidence = True
 
-        table = copy.copy(chosen_clique.get_prob_table())
+        # Calculate P(U |e) = P(U)L(X)/P(e)
+        table.multiply_table_in_place(BeliefTable([variable], likelihood))
+        table.divide_all(evidence_prob)
+        self._evidence_prob *= evidence_prob
+
+        self._record_likelihood(variable, likelihood)
 
-        # Select which cell in the table has to be set to 0(those that contradict the evidence)
-        confuted_values = [x for x in variable.values if x != value]
-        for conf_value in confuted_values:
-            coord_dict = {}
-            for el in table.get_variables():
-                if el != variable:
-                    coord_dict[el.name] = slice(None)
-                else:
-                    coord_dict[el.name] = conf_value
+    def set_evidence(self, evidence):
+        """
+        Enters evidence on several variables and propagates it once. The findings on variables that share the chosen
+        clique are combined into a single mask, which is multiplied in place into the clique, and normalization is left
+        to the propagation. If the evidence is conflicting, with itself or with the evidence entered before, the
+        JunctionTree goes back to the evidence entered before, which is entered again in the calibrated tables
+
+        :param evidence: each variable mapped to its observed value, or to the weights of its values for likelihood
+        evidence
+        :type evidence: dict[str or Variable,int or str or list[float]]
+        :return: None
+        """
+        likelihoods = {}
+        for variable, value in evidence.items():
+            if isinstance(variable, str):
+                variable = self.get_variable_by_name(variable)
+            if variable not in self._variables:
+                raise AttributeError("Variable not valid")
+
+            if isinstance(value, (list, np.ndarray)):
+                likelihoods[variable] = self._check_likelihood(variable, value)
+            else:
+                likelihoods[variable] = self._get_indicator(variable, value)
 
-            table.set_probability_dict(coord_dict, 0)
+        # The mask of each clique is the product of the likelihoods of its observed variables
+        masks = {}
+        for variable, likelihood in likelihoods.items():
+            clique = self._chosen_clique[variable]
+            factor = BeliefTable([variable], likelihood)
+            masks[clique] = factor if clique not in masks else masks[clique].multiply_table(factor)
 
-        # Calculate P(U |e) = P(U,e)/P(e)
+        # Only the evidence is saved, copying all the tables for each call would double the cost of entering it
+        previous_evidence = self._evidence.copy()
         try:
-            table.divide_all(table.marginalize([variable]).get_prob_dict({variable.name: value}))
-            chosen_clique.set_prob_table(table)
-        except RuntimeWarning:
-            raise RuntimeError("Conflicting evidence was entered")
+            for clique, mask in masks.items():
+                table = clique.get_prob_table()
+                table.multiply_table_in_place(mask)
+                if not np.any(table.get_prob(Ellipsis)):
+                    raise RuntimeError("Conflicting evidence was entered")
+                clique.received_evidence = True
+
+            for variable, likelihood in likelihoods.items():
+                self._record_likelihood(variable, likelihood)
+
+            self.sum_propagate()
+        except RuntimeError:
+            self._rebuild_from_prior(previous_evidence)
+            raise
+
+    @staticmethod
+    def _check_likelihood(variable, likelihood):
+        """
+        Checks that the likelihood has a non negative weight for each value of the variable and returns it as a new
+        numpy array
+
+        :type variable: Variable
+        :type likelihood: list[float] or np.ndarray
+        :rtype: np.ndarray
+        """
+        likelihood = np.array(likelihood, dtype=float)
+        if likelihood.shape != (variable.get_cardinality(),) or np.any(likelihood < 0):
+            raise AttributeError("The likelihood must have a non negative weight for each value of the variable")
+
+        return likelihood
+
+    def _record_likelihood(self, variable, likelihood):
+        """
+        Adds a likelihood entered on a variable to the recorded evidence
+
+        :type variable: Variable
+        :type likelihood: np.ndarray
+        :return: None
+        """
+        if variable in self._evidence:
+            likelihood = likelihood * self._evidence[variable]
+        self._evidence[variable] = likelihood
+
+    @staticmethod
+    def _get_indicator(variable, value):
+        """
+        Returns the likelihood of hard evidence on a variable: 1 for the given value and 0 for the others
+
+        :type variable: Variable
+        :type value: int or string
+        :rtype: np.ndarray
+        """
+        if isinstance(value, str):
+            value = value.lower()
+        if not variable.is_valid(value):
+            raise AttributeError("Value not valid")
+
+        indicator = np.zeros(variable.get_cardinality())
+        indicator[variable.get_value_index(value)] = 1
+
+        return indicator
+
+    def retract_evidence(self, variable):
+        """
+        Removes the evidence entered on a variable and propagates the remaining evidence. The tables are brought back
+        to the calibrated ones without evidence computed by initialize_tables, so only the remaining findings are
+        entered again
+
+        :type variable: Variable or str
+        :return: None
+        """
+        if isinstance(variable, str):
+            variable = self.get_variable_by_name(variable)
+        if variable not in self._evidence:
+            raise AttributeError("No evidence was entered on the variable")
+
+        evidence = self._evidence.copy()
+        del evidence[variable]
+        self._reenter_evidence(evidence)
+
+    def change_evidence(self, variable, value):
+        """
+        Replaces the value observed for a variable, or adds it if there was no evidence on the variable, and propagates
+        all the evidence. If the new value conflicts with the rest of the evidence the JunctionTree is left unchanged
+
+        :type variable: Variable or str
+        :param value: the new value of the variable
+        :type value: int or string
+        :return: None
+        """
+        if isinstance(variable, str):
+            variable = self.get_variable_by_name(variable)
+        if variable not in self._variables:
+            raise AttributeError("Variable not valid")
+
+        evidence = self._evidence.copy()
+        evidence[variable] = self._get_indicator(variable, value)
+        self._reenter_evidence(evidence)
+
+    def _reenter_evidence(self, evidence):
+        """
+        Resets the tables, enters the given evidence and propagates it. The previous evidence is entered again if the
+        evidence is conflicting
+
+        :param evidence: likelihood of each observed variable
+        :type evidence: dict[Variable,np.ndarray]
+        :return: None
+        """
+        previous_evidence = self._evidence.copy()
+        try:
+            self._rebuild_from_prior(evidence)
+        except RuntimeError:
+            self._rebuild_from_prior(previous_evidence)
+            raise
+
+    def _rebuild_from_prior(self, evidence):
+        """
+        Resets the tables, enters the given evidence and propagates it
+
+        :param evidence: likelihood of each observed variable
+        :type evidence: dict[Variable,np.ndarray]
+        :return: None
+        """
+        self.reset()
+        for variable, likelihood in evidence.items():
+            self.add_likelihood(variable, likelihood)
+        self.sum_propagate()
+
+    def get_evidence(self):
+        """
+        Returns the evidence entered since the tables were initialized: the name of each observed variable mapped to
+        its value for hard evidence, or to the weights of its values for likelihood evidence
+
+        :rtype: dict[str,int or str or list[float]]
+        """
+        evidence = {}
+        for variable, likelihood in self._evidence.items():
+            nonzero = np.flatnonzero(likelihood)
+            if len(nonzero) == 1 and likelihood[nonzero[0]] == 1:
+                evidence[variable.name] = list(variable.values)[nonzero[0]]
+            else:
+                evidence[variable.name] = likelihood.tolist()
+
+        return evidence
+
+    def get_evidence_probability(self):
+        """
+        Returns the probability of the evidence entered since the tables were initialized, P(e). It's exact once the
+        evidence has been propagated, before that evidence entered in different cliques is counted as independent
+
+        :rtype: float
+        """
+        return float(self._evidence_prob)
 
     def get_joint_probability_table(self):
         """
@@ -428,16 +938,20 @@ class JunctionTree(object):
         :return: joint probability table
         :rtype: BeliefTable
         """
-        # Multiply all the tables of the cliques
-        result_table = BeliefTable(self._variables, np.ones(util.get_shape_from_var_dict(self._variables)))
-        for clique in self._cliques:
-            result_table = result_table.multiply_table(clique.get_prob_table())
+        return self._contract_universe(self._variables)
 
-        # Divide the result by all the separator tables
-        for sep in self._separators:
-            result_table = result_table.divide_table(sep.get_prob_table())
+    def _contract_universe(self, keep_vars):
+        """
+        Marginalizes the joint probability table on keep_vars without building it: the tables of all cliques and the
+        inverted tables of all separators are contracted together
+
+        :type keep_vars: dict[Variable,None] or list[Variable]
+        :rtype: BeliefTable
+        """
+        tables = [clique.get_prob_table() for clique in self._cliques]
+        tables += [sep.get_prob_table().invert() for sep in self._separators]
 
-        return result_table
+        return BeliefTable.contract(tables, keep_vars)
 
     def calculate_variable_probability_on_universe(self, variable):
         """
@@ -457,9 +971,7 @@ class JunctionTree(object):
         if not variable_dict.keys() <= self._variables.keys():
             raise AttributeError("Variable not valid")
 
-        table = self.get_joint_probability_table()
-
-        marginalized_table = table.marginalize(variable_dict)
+        marginalized_table = self._contract_universe(variable_dict)
         norm_constant = 0
         i = 0
         for value in variable.values:
@@ -486,6 +998,55 @@ class JunctionTree(object):
         chosen_clique = self._chosen_clique[variable]
         return chosen_clique.get_prob_table().marginalize({variable: None})
 
+    def get_chosen_clique(self, variable):
+        """
+        Returns the clique chosen for the variable during the initialization of the tables, that is the clique that
+        contains the variable and its fathers where the table of the variable was stored
+
+        :type variable: Variable or str
+        :rtype: Node
+        """
+        if isinstance(variable, str):
+            variable = self.get_variable_by_name(variable)
+
+        if variable not in self._chosen_clique:
+            raise AttributeError("Variable not valid or tables not initialized")
+        return self._chosen_clique[variable]
+
+    def query(self, variable):
+        """
+        Calculate the probabilities of the given variable given the evidence entered, propagating only what is needed:
+        evidence is collected toward the smallest clique that contains the variable, where the variable is
+        marginalized. The other cliques are left as they are and stay marked as not calibrated, so the next
+        sum_propagate brings the whole JunctionTree up to date
+
+        :type variable: Variable or str
+        :return: normalized table over the single variable
+        :rtype: BeliefTable
+        """
+        if isinstance(variable, str):
+            variable = self.get_variable_by_name(variable)
+        if variable not in self._variables:
+            raise AttributeError("Variable not valid")
+
+        clique = self._query_cliques.get(variable)
+        if clique is None:
+            candidates = [el for el in self._cliques if variable in el.get_variables()]
+            clique = min(candidates, key=lambda el: el.get_prob_table().get_vars_size())
+            self._query_cliques[variable] = clique
+
+        # The clique stays marked as having received evidence, so that it's distributed by the next propagation
+        self._ensure_arena()
+        self.collect_evidence(clique)
+
+        table = clique.get_prob_table().marginalize([variable])
+        norm_constant = np.sum(table.get_prob(Ellipsis))
+        if norm_constant == 0:
+            raise RuntimeError("Conflicting evidence was entered")
+        table.divide_all(norm_constant)
+
+        return table
+
     @staticmethod
     def absorption(first, separator, second):
         """
@@ -503,116 +1064,389 @@ class JunctionTree(object):
         if (separator not in first.get_neighbours() or separator not in second.get_neighbours()
                 or first not in separator.get_neighbours() or second not in separator.get_neighbours()):
             raise AttributeError("Combination of nodes not valid")
+        JunctionTree._absorb(first, separator, second)
+
+    @staticmethod
+    def _absorb(first, separator, second, plan=None):
+        """
+        Absorption without checking that the nodes are linked, used when executing a propagation schedule
+
+        :type first: Node
+        :type separator: Node
+        :type second: Node
+        :param plan: plan of the absorption computed by _get_absorption_plan, if it's not given the operations of the
+        tables are used
+        :type plan: tuple
+        :return: None
+        """
+        if plan is not None:
+            _, _, _, v_array, s_array, w_array, sum_axes, permutation, alignment, aligned_shape = plan
+
+            # Same operations of the tables below, on the arrays of the tables with the axes computed by the plan
+            ts_star = np.transpose(np.sum(v_array, axis=sum_axes), permutation)
+            update = np.zeros(ts_star.shape)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                np.divide(ts_star, s_array, out=update, where=(ts_star != 0))
+            s_array[...] = ts_star
+            w_array *= np.transpose(update, alignment).reshape(aligned_shape)
+            return
+
         tv = first.get_prob_table()
         ts = separator.get_prob_table()
         tw = second.get_prob_table()
 
+        # Only the separator sized tables are allocated, the separator and W are updated in place
         ts_star = tv.marginalize(separator.get_variables())
-        separator.set_prob_table(ts_star)
+        update = ts_star.divide_table(ts)
+        ts.copy_table_from(ts_star)
 
-        second.set_prob_table(tw.multiply_table(ts_star.divide_table(ts)))
+        tw.multiply_table_in_place(update)
 
-    def distribute_evidence(self, node):
+    def _get_absorption_plan(self, first, separator, second):
+        """
+        Returns the plan of the absorption of second from first, computed once for each edge and direction so that
+        propagations don't look up the plans of the table operations: the arrays of the three tables, the axes of
+        first to sum over, the permutation that sorts the remaining axes like the separator and the permutation and
+        shape that align the separator to second. The plan is computed again if a table was replaced, None if the
+        tables are not float arrays with the shape of their variables, as the tables of the arena are
+
+        :type first: Node
+        :type separator: Node
+        :type second: Node
+        :rtype: tuple
+        """
+        tv = first.get_prob_table()
+        ts = separator.get_prob_table()
+        tw = second.get_prob_table()
+
+        plan = self._absorption_plans.get((first, separator, second))
+        if plan is not None and plan[0] is tv and plan[1] is ts and plan[2] is tw:
+            return plan
+
+        v_vars = list(tv.get_variables())
+        s_vars = list(ts.get_variables())
+        w_vars = list(tw.get_variables())
+        arrays = [tv.get_prob(Ellipsis), ts.get_prob(Ellipsis), tw.get_prob(Ellipsis)]
+        if any(array.dtype != float or array.shape != util.get_shape_from_var_dict(variables)
+               for array, variables in zip(arrays, [v_vars, s_vars, w_vars])):
+            return None
+
+        remaining_vars = [el for el in v_vars if el in ts.get_variables()]
+        sum_axes = tuple(i for i, el in enumerate(v_vars) if el not in ts.get_variables())
+        permutation = [remaining_vars.index(el) for el in s_vars]
+
+        # The update has the axes of the separator, they are sorted like in second before adding the missing ones
+        alignment = [s_vars.index(el) for el in w_vars if el in ts.get_variables()]
+        aligned_shape = tuple(el.get_cardinality() if el in ts.get_variables() else 1 for el in w_vars)
+
+        plan = (tv, ts, tw, arrays[0], arrays[1], arrays[2], sum_axes, permutation, alignment, aligned_shape)
+        self._absorption_plans[(first, separator, second)] = plan
+        return plan
+
+    def distribute_evidence(self, node, executor=None):
         """
         Second main operation of Hugin propagation. A node(initially the root node) sends all its neighbours the
         information it collected during previous CollectEvidence or DistributeEvidence, this is done recursively.
+        If an executor is given the children of the cliques of each level of the tree are updated concurrently
 
         :param node: the Node that sends its neighbours information
         :type node: Node
+        :param executor: executor that runs the absorptions, None to run them in this thread
+        :type executor: concurrent.futures.Executor
         :return: None
         """
-        if node not in self._cliques:
+        if not self._is_clique(node):
             raise AttributeError("Wrong starting clique")
 
-        # Keep track of visited nodes
-        visited_labels = dict.fromkeys(self._cliques, False)
+        if executor is None:
+            for parent, separator, child in self.get_propagation_schedule(node):
+                JunctionTree._absorb(parent, separator, child, self._get_absorption_plan(parent, separator, child))
+            return
 
-        # Perform a pseudo-BF traversal
-        queue = []
-        visited_labels[node] = True
-        queue.append(node)
+        # Each absorption of a level only reads its parent, which was updated in the previous level, and writes its own
+        # separator and child
+        for level in self.get_propagation_levels(node):
+            list(executor.map(lambda edge: JunctionTree._absorb(*edge, self._get_absorption_plan(*edge)), level))
 
-        while len(queue) != 0:
-            v = queue.pop(0)
-
-            for neighbour in self.get_neighbouring_cliques(v):
-                if not visited_labels[neighbour]:
-                    visited_labels[neighbour] = True
-                    queue.append(neighbour)
-
-                    common_separator = [x for x in v.get_neighbours() if x in neighbour.get_neighbours()][0]
-                    JunctionTree.absorption(v, common_separator, neighbour)
-
-    def collect_evidence(self, node):
+    def collect_evidence(self, node, executor=None):
         """
         First main operation of Hugin propagation.
         A node asks all its neighbours to send it evidence, if they are not allowed to do so (they haven't received
-        evidence either) they pass the request to all their neighbouring nodes, except to the one that sent it
+        evidence either) they pass the request to all their neighbouring nodes, except to the one that sent it.
+        Messages are sent in a single pass from the leaves to node, each edge is absorbed at most once and subtrees
+        without new evidence since the last propagation send nothing. At the end node is marked as having received
+        evidence if anything reached it, so that DistributeEvidence knows it has to send it out.
+        If an executor is given the cliques of each level of the tree collect from their children concurrently
 
         :param node: the node that asks its neighbours for evidence
         :type node: Node
+        :param executor: executor that runs the absorptions, None to run them in this thread
+        :type executor: concurrent.futures.Executor
         :return: None
         """
-        if node not in self._cliques:
+        if executor is None:
+            # Children come after their parents in the schedule, so going backwards every clique sends its message
+            # after having received those of its whole subtree
+            for parent, separator, child in reversed(self.get_propagation_schedule(node)):
+                self._collect_edge(parent, separator, child)
+            return
+
+        # Starting from the deepest level, every clique absorbs the messages of its children in a single task, so that
+        # no two tasks write the same table
+        for level in reversed(self.get_propagation_levels(node)):
+            edges_by_parent = {}
+            for parent, separator, child in level:
+                edges_by_parent.setdefault(parent, []).append((parent, separator, child))
+
+            list(executor.map(self._collect_edges, edges_by_parent.values()))
+
+    def _collect_edge(self, parent, separator, child):
+        """
+        Sends the message of child to parent if child received new evidence and updates the state of evidence
+        collecting
+
+        :type parent: Node
+        :type separator: Node
+        :type child: Node
+        :return: None
+        """
+        if child.received_evidence:
+            JunctionTree._absorb(child, separator, parent, self._get_absorption_plan(child, separator, parent))
+
+            child.received_evidence = False
+            parent.received_evidence = True
+
+    def _collect_edges(self, edges):
+        """
+        Runs _collect_edge on each of the given (parent, separator, child) triples
+
+        :type edges: list[tuple[Node,Node,Node]]
+        :return: None
+        """
+        for parent, separator, child in edges:
+            self._collect_edge(parent, separator, child)
+
+    def get_propagation_schedule(self, root):
+        """
+        Returns the edges of the JunctionTree as (parent, separator, child) triples, in breadth first order starting
+        from root. DistributeEvidence absorbs along them in order, CollectEvidence in the opposite direction.
+        The schedule is compiled once for each root and reused until the structure of the tree changes
+
+        :param root: the clique the traversal starts from
+        :type root: Node
+        :rtype: tuple[tuple[Node,Node,Node]]
+        """
+        if not self._is_clique(root):
             raise AttributeError("Wrong starting clique")
 
-        # Keep track of visited nodes
-        visited_labels = dict.fromkeys(self._cliques, False)
+        schedule = self._schedules.get(root)
+        if schedule is None:
+            schedule = self._compile_schedule(root)
+            self._schedules[root] = schedule
+
+        return schedule
 
-        # Keep track of traversal to send back evidence to the correct node
-        parents = dict.fromkeys(self._cliques, None)
+    def get_propagation_levels(self, root):
+        """
+        Returns the propagation schedule of root split by the depth of the child of each edge: the i-th level contains
+        the edges whose child is at distance i+1 from root. The absorptions of a level don't depend on each other
+
+        :param root: the clique the traversal starts from
+        :type root: Node
+        :rtype: tuple[tuple[tuple[Node,Node,Node]]]
+        """
+        levels = self._levels.get(root)
+        if levels is None:
+            depths = {root: 0}
+            levels = []
+            for parent, separator, child in self.get_propagation_schedule(root):
+                depths[child] = depths[parent] + 1
+                if depths[child] > len(levels):
+                    levels.append([])
+                levels[-1].append((parent, separator, child))
 
-        # Perform a pseudo-BF traversal
-        queue = []
-        visited_labels[node] = True
-        queue.append(node)
+            levels = tuple(tuple(level) for level in levels)
+            self._levels[root] = levels
+
+        return levels
+
+    @staticmethod
+    def _compile_schedule(root):
+        """
+        Breadth first traversal of the JunctionTree from root, recording the separator crossed to reach each clique
+
+        :type root: Node
+        :rtype: tuple[tuple[Node,Node,Node]]
+        """
+        visited = {root: None}
+        queue = deque([root])
+        schedule = []
 
         while len(queue) != 0:
-            v = queue.pop(0)
+            v = queue.popleft()
+
+            for separator in v.get_neighbours():
+                for neighbour in separator.get_neighbours():
+                    if neighbour not in visited:
+                        visited[neighbour] = None
+                        queue.append(neighbour)
+                        schedule.append((v, separator, neighbour))
+
+        return tuple(schedule)
+
+    def estimate_cost(self):
+        """
+        Static estimate of the cost of a full propagation(CollectEvidence, DistributeEvidence and normalization) for
+        each clique used as root, computed from the sizes of the tables:
+        -'flops': number of operations on table entries, an absorption V->S->W costs |V|+|S|+|W| (marginalization,
+        division and multiplication) and normalization costs |root| plus the size of all tables
+        -'memory': peak number of bytes used, that is all the tables plus the temporaries of the largest absorption
+        -'depth': operations on the critical path, that is the most expensive chain of absorptions from the root to a
+        leaf and back, which bounds the time of a propagation where independent absorptions run in parallel
+
+        :return: the costs of each clique
+        :rtype: dict[Node,dict[str,int]]
+        """
+        all_sizes = 0
+        for node in self._cliques + self._separators:
+            all_sizes += node.get_prob_table().get_vars_size()
 
-            # If a Node with evidence is found propagate its information over all its ancestors
-            if v.received_evidence:
-                current_child = v
-                ancestors = parents[current_child]
-                while ancestors is not None:
-                    common_separator = [x for x in current_child.get_neighbours() if x in ancestors.get_neighbours()][0]
+        # Every edge is absorbed once in each direction whatever the root
+        edges_flops = 0
+        largest_absorption = 0
+        weighted_neighbours = {clique: [] for clique in self._cliques}
+        for sep in self._separators:
+            # Separators that don't link two cliques yet aren't absorbed through
+            if len(sep.get_neighbours()) < 2:
+                continue
+            first, second = sep.get_neighbours()[0], sep.get_neighbours()[-1]
+            first_size = first.get_prob_table().get_vars_size()
+            sep_size = sep.get_prob_table().get_vars_size()
+            second_size = second.get_prob_table().get_vars_size()
+
+            round_trip = first_size + 2 * sep_size + second_size
+            edges_flops += 2 * round_trip
+            largest_absorption = max(largest_absorption, 2 * sep_size + max(first_size, second_size))
+
+            weighted_neighbours[first].append((second, round_trip))
+            weighted_neighbours[second].append((first, round_trip))
+
+        # The depth of a root is its eccentricity in the tree weighted by round trips, which is its distance from the
+        # farthest end of a diameter of the tree
+        depth = dict.fromkeys(self._cliques, 0)
+        if len(self._cliques) != 0:
+            first_end = self._get_farthest_clique(self._cliques[0], weighted_neighbours)[0]
+            second_end, from_first = self._get_farthest_clique(first_end, weighted_neighbours)
+            _, from_second = self._get_farthest_clique(second_end, weighted_neighbours)
+            depth = {clique: max(from_first.get(clique, 0), from_second.get(clique, 0)) for clique in self._cliques}
+
+        costs = {}
+        for clique in self._cliques:
+            costs[clique] = {'flops': int(edges_flops + clique.get_prob_table().get_vars_size() + all_sizes),
+                             'memory': int((all_sizes + largest_absorption) * np.dtype(float).itemsize),
+                             'depth': int(depth[clique])}
 
-                    JunctionTree.absorption(current_child, common_separator, ancestors)
+        return costs
 
-                    current_child = ancestors
-                    ancestors = parents[current_child]
+    @staticmethod
+    def _get_farthest_clique(start, weighted_neighbours):
+        """
+        Returns the clique farthest from start in the weighted tree, together with the distance of every clique from
+        start
+
+        :type start: Node
+        :type weighted_neighbours: dict[Node,list[tuple[Node,int]]]
+        :rtype: tuple[Node,dict[Node,int]]
+        """
+        distances = {start: 0}
+        stack = [start]
+        while len(stack) != 0:
+            v = stack.pop()
+            for neighbour, weight in weighted_neighbours[v]:
+                if neighbour not in distances:
+                    distances[neighbour] = distances[v] + weight
+                    stack.append(neighbour)
+
+        return max(distances, key=distances.get), distances
+
+    def get_best_root(self, criterion='flops'):
+        """
+        Returns the clique that should be used as root of the propagation according to estimate_cost: with 'flops' the
+        cheapest root, with 'depth' the one with the shortest critical path. Ties are broken by the other criterion and
+        then by the order of the cliques
+
+        :type criterion: str
+        :rtype: Node
+        """
+        if criterion not in ('flops', 'depth'):
+            raise AttributeError("Unknown criterion: " + str(criterion))
 
-                # Update the state of evidence collecting
-                v.received_evidence = False
+        if criterion not in self._best_roots:
+            other = 'depth' if criterion == 'flops' else 'flops'
+            costs = self.estimate_cost()
+            self._best_roots[criterion] = min(self._cliques, key=lambda c: (costs[c][criterion], costs[c][other]))
 
-            for neighbour in self.get_neighbouring_cliques(v):
-                if not visited_labels[neighbour]:
-                    visited_labels[neighbour] = True
-                    parents[neighbour] = v
-                    queue.append(neighbour)
+        return self._best_roots[criterion]
 
-    def sum_propagate(self):
+    def sum_propagate(self, root=None, criterion='flops', workers=None):
         """
         Operation that propagates the evidence over all the JunctionTree by calling CollectEvidence, DistributeEvidence
-        and then normalizing the tables of all cliques/separator
+        and then normalizing the tables of all cliques/separator. Nothing is done if no clique received evidence since
+        the last propagation. RuntimeError is raised if the evidence entered in different cliques is conflicting, in
+        that case the tables are not normalized.
+        With more than one worker the independent absorptions run in a thread pool, which only pays off when the
+        tables are large enough for numpy to spend most of the time outside the GIL
+
+        :param root: clique to use as root, if it's not given it's chosen by get_best_root
+        :type root: Node
+        :param criterion: criterion used to choose the root, 'flops' or 'depth'
+        :type criterion: str
+        :param workers: number of threads, None or 1 to propagate in this thread. The thread pool is kept by the tree
+        and reused by the next propagations with the same number of workers
+        :type workers: int
+        :return: None
         """
-        # Choose a root(any one should be fine)
-        root = self._cliques[0]
+        if root is None:
+            root = self.get_best_root(criterion)
+        self._ensure_arena()
+
+        if workers is None or workers <= 1:
+            self.collect_evidence(root)
+            if not root.received_evidence:
+                # No new evidence since the last propagation, the tree is already consistent
+                return
+            self.distribute_evidence(root)
+        else:
+            executor = self._get_executor(workers)
+            self.collect_evidence(root, executor)
+            if not root.received_evidence:
+                return
+            self.distribute_evidence(root, executor)
 
-        self.collect_evidence(root)
-        self.distribute_evidence(root)
+        root.received_evidence = False
 
         # Normalize
-        # Find normalizing constant by marginalizing on any variable
-        variable_chosen = list(self._variables)[0]
-        norm_table = self.calculate_variable_probability(variable_chosen)
+        # After propagation every table has the same total, the root is summed since it was chosen to be cheap
+        norm_constant = np.sum(root.get_prob_table().get_prob(Ellipsis))
+        if norm_constant == 0:
+            raise RuntimeError("Conflicting evidence was entered")
+        self._arena /= norm_constant
+        self._evidence_prob *= norm_constant
 
-        norm_constant = 0
-        for i in range(len(variable_chosen.values)):
-            norm_constant += norm_table.get_prob(i)
+    def _get_executor(self, workers):
+        """
+        Returns the thread pool of the tree with the given number of workers, the previous one is shut down if it had
+        a different number of workers
 
-        for node in self._cliques + self._separators:
-            node.get_prob_table().divide_all(norm_constant)
+        :type workers: int
+        :rtype: ThreadPoolExecutor
+        """
+        if self._executor is None or self._executor_workers != workers:
+            if self._executor is not None:
+                self._executor.shutdown()
+            self._executor = ThreadPoolExecutor(max_workers=workers)
+            self._executor_workers = workers
+        return self._executor
 
     def get_neighbouring_cliques(self, clique):
         """
@@ -622,7 +1456,7 @@ class JunctionTree(object):
         :return: neighbouring cliques
         :rtype: list[Node]
         """
-        if clique not in self._cliques:
+        if not self._is_clique(clique):
             raise AttributeError("Clique not valid")
 
         neigh_cliques = []
@@ -645,32 +1479,120 @@ class JunctionTree(object):
         if self._variables != bayes_net.get_variables():
             raise AttributeError("The variables in the BayesianNet and in the JunctionTree aren't the same")
         # Set all separators and cliques to 1
-        for node in self._separators + self._cliques:
-            node.get_prob_table().set_probability_coord((slice(None),) * len(node.get_variables()), 1)
+        self._ensure_arena()
+        self._arena[...] = 1
+
+        # Cliques that contain each variable, in the order of the cliques, with the set of variables of each clique
+        cliques_of_var = {variable: [] for variable in self._variables}
+        clique_vars = {}
+        for clique in self._cliques:
+            clique_vars[clique] = frozenset(clique.get_variables())
+            for variable in clique_vars[clique]:
+                cliques_of_var[variable].append(clique)
 
         # Choose the correct clique for each variable and store its table in it
         for variable in self._variables:
-            clique_for_var = [variable] + bayes_net.get_fathers(variable)
+            clique_for_var = frozenset([variable] + bayes_net.get_fathers(variable))
 
-            # Find the first clique that contains a variable and its fathers
+            # Find the last clique that contains a variable and its fathers, among the cliques of the member of the
+            # family that is in the fewest cliques
+            candidates = min((cliques_of_var[v] for v in clique_for_var), key=len)
             clique_ref = None
-            for clique in self._cliques:
-                if all(v in list(clique.get_variables().keys()) for v in clique_for_var):
+            for clique in reversed(candidates):
+                if clique_for_var <= clique_vars[clique]:
                     clique_ref = clique
+                    break
             if clique_ref is None:
-                raise AttributeError(str(clique_for_var) + " wasn't found")
+                raise AttributeError(str(list(clique_for_var)) + " wasn't found")
 
             self._chosen_clique[variable] = clique_ref
 
             table = bayes_net.get_table(variable)
-            clique_ref.set_prob_table(clique_ref.get_prob_table().multiply_table(table))
+            clique_ref.get_prob_table().multiply_table_in_place(table)
 
         # Distribute initial information by allowing a round of message passing
-        for node in self._cliques:
-            if node in self._chosen_clique.values():
-                node.received_evidence = True
+        for node in set(self._chosen_clique.values()):
+            node.received_evidence = True
 
+        self._evidence = {}
         self.sum_propagate()
+        self._evidence_prob = 1.0
+        self._prior = self.snapshot()
+        self._model_id = self._compute_model_id()
+
+    def snapshot(self):
+        """
+        Returns a copy of the tables of all cliques and separators, of their state of evidence collecting and of the
+        evidence entered, that can be given to restore to bring the JunctionTree back to this moment. Copying the
+        tables is a single copy of the arena
+
+        :return: the snapshot, to be used only with restore on this JunctionTree
+        :rtype: tuple
+        """
+        self._ensure_arena()
+        nodes = self._cliques + self._separators
+        return (self._arena_tables, self._arena.copy(), [node.received_evidence for node in nodes],
+                self._evidence.copy(), self._evidence_prob)
+
+    def restore(self, snapshot):
+        """
+        Brings the tables of all cliques and separators and the evidence back to how they were when the snapshot was
+        taken
+
+        :param snapshot: snapshot returned by snapshot
+        :type snapshot: tuple
+        :return: None
+        """
+        arena_tables, arena, flags, evidence, evidence_prob = snapshot
+
+        self._ensure_arena()
+        if arena_tables is not self._arena_tables:
+            raise AttributeError("The snapshot was taken on different tables")
+
+        self._arena[...] = arena
+        for node, flag in zip(self._cliques + self._separators, flags):
+            node.received_evidence = flag
+        self._evidence = evidence.copy()
+        self._evidence_prob = evidence_prob
+
+    def get_model_id(self):
+        """
+        Returns an identifier of the model, computed from the variables of the cliques and separators and from their
+        calibrated tables without evidence. Two JunctionTrees have the same identifier if they give the same results,
+        e.g. copies of a model loaded from the same file, and the identifier changes with the tables of the model.
+        None if the tables weren't initialized after the last change of the structure
+
+        :rtype: str
+        """
+        return self._model_id
+
+    def _compute_model_id(self):
+        """
+        Hashes the variables of all cliques and separators and their tables, called when they are calibrated and
+        without evidence
+
+        :rtype: str
+        """
+        digest = hashlib.sha1()
+        for node in self._cliques + self._separators:
+            for variable in node.get_variables():
+                digest.update(repr((variable.name, tuple(variable.values))).encode())
+            digest.update(b';')
+        digest.update(self._arena.tobytes())
+
+        return digest.hexdigest()
+
+    def reset(self):
+        """
+        Removes all evidence by restoring the calibrated tables computed by initialize_tables, which is much cheaper
+        than initializing the tables again
+
+        :return: None
+        """
+        if self._prior is None:
+            raise AttributeError("The tables have to be initialized first")
+
+        self.restore(self._prior)
 
     def get_clique_from_dict(self, clique):
         """
@@ -680,11 +1602,7 @@ class JunctionTree(object):
         :return: the clique or None if it doesn't exists
         :rtype: Node
         """
-        clique = dict.fromkeys(clique)
-        for element in self._cliques:
-            if element.get_variables() == clique:
-                return element
-        return None
+        return self._clique_index.get(frozenset(clique))
 
     def get_separator_from_dict(self, sep):
         """
@@ -694,11 +1612,10 @@ class JunctionTree(object):
         :return: the separator or None if it doesn't exists
         :rtype: Node
         """
-        sep = dict.fromkeys(sep)
-        for element in self._separators:
-            if element.get_variables() == sep:
-                return element
-        return None
+        separators = self._separator_index.get(frozenset(sep))
+        if separators is None:
+            return None
+        return separators[0]
 
     def get_variable_by_name(self, name):
         """
@@ -707,10 +1624,9 @@ class JunctionTree(object):
         :type name: str
         :rtype: Variable
         """
-        for var in self._variables:
-            if name == var.name:
-                return var
-        raise AttributeError("Variable not found")
+        if name not in self._variables_by_name:
+            raise AttributeError("Variable not found")
+        return self._variables_by_name[name]
 
     def get_variables(self):
         """
@@ -754,6 +1670,35 @@ class JunctionTree(object):
 
         return rstring
 
+    def __getstate__(self):
+        # Compiled schedules and roots are not saved
+        state = self.__dict__.copy()
+        del state['_schedules']
+        del state['_levels']
+        del state['_best_roots']
+        del state['_query_cliques']
+        del state['_absorption_plans']
+        del state['_arena']
+        del state['_arena_tables']
+        del state['_prior']
+        state['_executor'] = None
+        state['_executor_workers'] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._structure_changed()
+
+        # Trees saved before the lookup indexes were introduced have to build them
+        if '_clique_index' not in state:
+            self._build_indexes()
+        if '_evidence' not in state:
+            self._evidence = {}
+            self._evidence_prob = 1.0
+        if '_executor' not in state:
+            self._executor = None
+            self._executor_workers = None
+
 
 class Node(object):
     """
@@ -823,3 +1768,159 @@ class Node(object):
         :rtype: string
         """
         return '.'.join([x.name for x in list(self.get_variables())])
+
+
+class PosteriorCache(object):
+    """
+    Bounded LRU cache of the probabilities computed by JunctionTrees, keyed by the model, the evidence and the
+    queried variables. Models are identified by JunctionTree.get_model_id, so copies of the same model share results
+    and the results of a model are dropped as soon as one of its JunctionTrees is initialized with different tables.
+    The size of the cache is given in bytes of the stored tables
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        """
+        :param max_bytes: maximum number of bytes of the tables kept in the cache
+        :type max_bytes: int
+        """
+        self.max_bytes = max_bytes
+
+        """
+        Ordered dictionary of results, each is a dictionary from the names of the variables to their tables and the
+        number of bytes of the tables. The least recently used one is the first
+        """
+        self._results = OrderedDict()
+
+        """
+        Keys of the results of each model and the last model seen for each JunctionTree, used for invalidation
+        """
+        self._keys_by_model = {}
+        self._models = weakref.WeakKeyDictionary()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.bytes = 0
+
+    def query(self, jtree, evidence, variables):
+        """
+        Returns the probabilities of the variables given the evidence. If they're not in the cache the evidence of the
+        JunctionTree is replaced by the given one, propagated and the results are stored
+
+        :param jtree: initialized JunctionTree
+        :type jtree: JunctionTree
+        :param evidence: each variable mapped to its observed value, or to the weights of its values, see
+        JunctionTree.set_evidence
+        :type evidence: dict[str or Variable,int or str or list[float]]
+        :param variables: variables to compute
+        :type variables: list[str or Variable]
+        :return: a copy of the table of each variable, by name
+        :rtype: dict[str,BeliefTable]
+        """
+        model_id = jtree.get_model_id()
+        if model_id is None:
+            raise AttributeError("The tables of the JunctionTree have to be initialized first")
+        self._check_model(jtree, model_id)
+
+        names = [el if isinstance(el, str) else el.name for el in variables]
+        key = (model_id, self._get_evidence_key(evidence), tuple(sorted(set(names))))
+
+        result = self._results.get(key)
+        if result is not None:
+            self.hits += 1
+            self._results.move_to_end(key)
+            tables = result[0]
+        else:
+            self.misses += 1
+            jtree.reset()
+            jtree.set_evidence(evidence)
+            tables = {name: jtree.calculate_variable_probability(name) for name in key[2]}
+            self._store(key, tables)
+
+        return {name: copy.copy(tables[name]) for name in names}
+
+    @staticmethod
+    def _get_evidence_key(evidence):
+        """
+        Returns the evidence in a canonical form: its items sorted by the name of the variable, with lowercase values
+        and weights as tuples
+
+        :type evidence: dict[str or Variable,int or str or list[float]]
+        :rtype: tuple
+        """
+        items = []
+        for variable, value in evidence.items():
+            name = variable if isinstance(variable, str) else variable.name
+            if isinstance(value, str):
+                value = value.lower()
+            elif isinstance(value, (list, np.ndarray)):
+                value = tuple(float(el) for el in value)
+            items.append((name, value))
+
+        return tuple(sorted(items, key=lambda el: el[0]))
+
+    def _check_model(self, jtree, model_id):
+        """
+        Records the model of a JunctionTree, if the JunctionTree had a different model before and no other
+        JunctionTree has it, the results of that model are dropped
+
+        :type jtree: JunctionTree
+        :type model_id: str
+        :return: None
+        """
+        previous = self._models.get(jtree)
+        self._models[jtree] = model_id
+
+        if previous is not None and previous != model_id and previous not in self._models.values():
+            self.invalidate(previous)
+
+    def _store(self, key, tables):
+        """
+        Stores the tables of a result and evicts the least recently used results until the cache fits in max_bytes.
+        Results bigger than the whole cache aren't stored
+
+        :type key: tuple
+        :type tables: dict[str,BeliefTable]
+        :return: None
+        """
+        size = sum(table.get_prob(Ellipsis).nbytes for table in tables.values())
+        if size > self.max_bytes:
+            return
+
+        self._results[key] = (tables, size)
+        self._keys_by_model.setdefault(key[0], set()).add(key)
+        self.bytes += size
+
+        while self.bytes > self.max_bytes:
+            old_key, (_, old_size) = self._results.popitem(last=False)
+            self._keys_by_model[old_key[0]].discard(old_key)
+            self.bytes -= old_size
+            self.evictions += 1
+
+    def invalidate(self, model_id=None):
+        """
+        Drops the results of a model, or all results if no model is given
+
+        :param model_id: identifier of the model, see JunctionTree.get_model_id
+        :type model_id: str
+        :return: None
+        """
+        if model_id is None:
+            self._results.clear()
+            self._keys_by_model.clear()
+            self.bytes = 0
+            return
+
+        for key in self._keys_by_model.pop(model_id, set()):
+            self.bytes -= self._results.pop(key)[1]
+
+    def info(self):
+        """
+        Returns the statistics of the cache
+
+        :rtype: dict[str,int or float]
+        """
+        requests = self.hits + self.misses
+        return {'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hits / requests if requests != 0 else 0.0,
+                'evictions': self.evictions, 'bytes': self.bytes, 'max_bytes': self.max_bytes,
+                'size': len(self._results)}
@@ -0,0 +1,101 @@
+#
+# Command line interface for running inference without the menu:
+#   python -m bnjt infer model.dat [--query A,B] < cases.jsonl > results.jsonl
+# Each line of the input is a JSON object with the evidence of a case and optionally the variables to compute and an
+# id, e.g. {"id": 1, "evidence": {"A": "a1", "B": [0.8, 0.2]}, "query": ["C"]}
+# Each line of the output has the id, the probabilities of the variables and P(e) of the case, or an error
+#
+import argparse
+import json
+import sys
+
+import util
+
+
+def infer(model_path, input_stream, output_stream, query=None):
+    """
+    Loads a model and runs inference on each case read from input_stream, writing one line of results for each case
+    to output_stream. Cases are processed one at a time and the tables are reset between them, so memory doesn't grow
+    with the number of cases
+
+    :param model_path: file with a bayesian net and its junction tree, see util.load_model
+    :type model_path: str
+    :param input_stream: JSON lines with the cases
+    :type input_stream: io.TextIOBase
+    :param output_stream: where the JSON lines with the results are written
+    :type output_stream: io.TextIOBase
+    :param query: names of the variables to compute when a case doesn't specify them, all variables if not given
+    :type query: list[str]
+    :return: number of lines that couldn't be processed, conflicting evidence is a valid result
+    :rtype: int
+    """
+    net, jtree = util.load_model(model_path)
+    jtree.initialize_tables(net)
+
+    if query is None:
+        query = [variable.name for variable in jtree.get_variables()]
+
+    errors = 0
+    for line in input_stream:
+        if line.strip() == '':
+            continue
+
+        result = {}
+        try:
+            case = json.loads(line)
+            if not isinstance(case, dict):
+                raise ValueError("Each case must be a JSON object")
+            if 'id' in case:
+                result['id'] = case['id']
+
+            jtree.reset()
+            jtree.set_evidence(case.get('evidence', {}))
+
+            result['marginals'] = {name: get_marginal(jtree, name) for name in case.get('query', query)}
+            result['evidence_probability'] = jtree.get_evidence_probability()
+        except RuntimeError as e:
+            result['error'] = str(e)
+            result['evidence_probability'] = 0.0
+        except (ValueError, AttributeError, TypeError) as e:
+            result['error'] = str(e)
+            errors += 1
+
+        output_stream.write(json.dumps(result) + '\n')
+
+    return errors
+
+
+def get_marginal(jtree, name):
+    """
+    Returns the probabilities of a variable of a propagated JunctionTree as a dictionary from its values to their
+    probability
+
+    :type jtree: JunctionTree
+    :type name: str
+    :rtype: dict[str,float]
+    """
+    variable = jtree.get_variable_by_name(name)
+    table = jtree.calculate_variable_probability(variable)
+
+    return {str(value): float(table.get_prob(i)) for i, value in enumerate(variable.values)}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='bnjt', description="Inference on bayesian nets with junction trees")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    infer_parser = subparsers.add_parser('infer', help="read cases as JSON lines from stdin, write their results to "
+                                                       "stdout")
+    infer_parser.add_argument('model', help="model file, as saved by util.serialize_model")
+    infer_parser.add_argument('--query', help="comma separated names of the variables to compute, all by default")
+
+    args = parser.parse_args(argv)
+
+    query = None if args.query is None else [name.strip() for name in args.query.split(',')]
+    errors = infer(args.model, sys.stdin, sys.stdout, query)
+
+    return 1 if errors > 0 else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
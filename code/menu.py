@@ -61,13 +61,15 @@ def show_loaded_model_menu(model, net, jtree):
     load_new_model_item = SubmenuItem("Load a new model", load_new_model, menu=menu, should_exit=True)
 
     add_evidence = FunctionItem("Add evidence", function=add_evidence_option, args=[jtree])
+    add_multiple_evidence = FunctionItem("Add and propagate multiple evidence", function=add_multiple_evidence_option, args=[jtree])
     get_probability = FunctionItem("Get probability of a variable", function=get_probability_option, args=[jtree])
-    reset_model = FunctionItem("Reset Model", function=lambda net, jtree : [jtree.initialize_tables(net), print("Tables reinitialized")], args=[net, jtree])
+    reset_model = FunctionItem("Reset Model", function=lambda jtree : [jtree.reset(), print("Tables reinitialized")], args=[jtree])
 
     menu.append_item(describe_bnet)
     menu.append_item(describe_jtree)
     menu.append_item(visualize)
     menu.append_item(add_evidence)
+    menu.append_item(add_multiple_evidence)
     menu.append_item(get_probability)
     menu.append_item(propagate)
     menu.append_item(reset_model)
@@ -111,6 +113,23 @@ def add_evidence_option(jtree):
         print("Conflicting evidence was entered, operation aborted")
 
 
+def add_multiple_evidence_option(jtree):
+    vars = list(jtree.get_variables().keys())
+    for var in vars:
+        print(var)
+
+    in_str = input("Insert evidence in the form <variable>,<value>;<variable>,<value>... :").strip()
+    try:
+        evidence = dict(el.strip().split(',') for el in in_str.split(';'))
+
+        jtree.set_evidence(evidence)
+        print("Evidence entered and propagated successfully")
+    except ValueError:
+        print("Wrong format")
+    except RuntimeError:
+        print("Conflicting evidence was entered, operation aborted")
+
+
 def get_probability_option(jtree: JunctionTree):
     vars = list(jtree.get_variables().keys())
     for var in vars:
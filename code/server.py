@@ -0,0 +1,526 @@
+#
+# This file contains a local HTTP/JSON inference server, built only on the standard library:
+#   python server.py models/studfarm.dat [name=path ...] [--port 8080] [--replicas 4] [--workers 8]
+#                    [--session-timeout 300] [--acquire-timeout 30]
+# Each model is loaded once and kept as a pool of initialized JunctionTree replicas. A replica is checked out for each
+# request, or for the whole life of a session, and propagation runs in a thread pool with a worker for each core.
+# Sessions that are idle for longer than the session timeout are closed, requests that wait for a replica longer than
+# the acquire timeout get 503.
+# Endpoints, all bodies are JSON:
+#   POST   /infer                      {"model", "evidence", "query"} -> {"marginals", "evidence_probability"}
+#   POST   /sessions                   {"model"} -> {"session"}
+#   POST   /sessions/<id>/evidence     {"evidence", "query"} -> {"marginals", "evidence_probability"}
+#   POST   /sessions/<id>/reset        removes the evidence of the session
+#   DELETE /sessions/<id>              closes the session and gives its replica back to the pool
+#   GET    /models                     models and available replicas
+#   GET    /stats                      requests, queue depth and latency percentiles
+#
+import argparse
+import asyncio
+import json
+import os
+import pickle
+import time
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+import bnjt
+import util
+
+STATUS_MESSAGES = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 409: 'Conflict', 503: 'Service Unavailable'}
+
+
+class HTTPError(Exception):
+    """
+    Error that is sent to the client with the given status
+    """
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class ModelPool(object):
+    """
+    Initialized replicas of the JunctionTree of a model, each replica is used by a single request or session at a time
+    """
+
+    def __init__(self, model_path, replicas):
+        """
+        :param model_path: file with a bayesian net and its junction tree, see util.load_model
+        :type model_path: str
+        :param replicas: number of copies of the JunctionTree
+        :type replicas: int
+        """
+        if replicas < 1:
+            raise AttributeError("At least a replica is needed")
+
+        net, jtree = util.load_model(model_path)
+        data = pickle.dumps(jtree)
+
+        """
+        Replicas that are not checked out
+        """
+        self._available = asyncio.Queue()
+        for _ in range(replicas):
+            replica = pickle.loads(data)
+            replica.initialize_tables(net)
+            self._available.put_nowait(replica)
+
+        self.replicas = replicas
+
+    async def acquire(self, timeout=None):
+        """
+        Checks out a replica, waiting until one is available. Raises asyncio.TimeoutError if none is available within
+        the timeout
+
+        :param timeout: seconds to wait, None to wait forever
+        :type timeout: float
+        :rtype: JunctionTree
+        """
+        return await asyncio.wait_for(self._available.get(), timeout)
+
+    def release(self, replica):
+        """
+        Gives a replica back to the pool after removing its evidence
+
+        :type replica: JunctionTree
+        :return: None
+        """
+        replica.reset()
+        self._available.put_nowait(replica)
+
+    def get_available(self):
+        """
+        :return: number of replicas that are not checked out
+        :rtype: int
+        """
+        return self._available.qsize()
+
+
+class Session(object):
+    """
+    Replica checked out by a client, the evidence it enters is kept between requests
+    """
+
+    def __init__(self, model, replica):
+        """
+        :type model: str
+        :type replica: JunctionTree
+        """
+        self.model = model
+        self.replica = replica
+
+        """
+        Requests of the same session are executed one at a time, closing it waits for the request being executed
+        """
+        self.lock = asyncio.Lock()
+
+        """
+        Whether the replica was given back to the pool, and the time the session was last used
+        """
+        self.closed = False
+        self.last_used = time.monotonic()
+
+
+class InferenceServer(object):
+    """
+    Asyncio HTTP server that answers inference requests on a set of models
+    """
+
+    def __init__(self, models, replicas=2, workers=None, latency_window=1000, session_timeout=300,
+                 acquire_timeout=30):
+        """
+        :param models: name of each model mapped to its file
+        :type models: dict[str,str]
+        :param replicas: number of JunctionTree replicas of each model
+        :type replicas: int
+        :param workers: maximum number of propagations running at the same time, the number of cores if not given
+        :type workers: int
+        :param latency_window: number of recent requests used for the latency percentiles
+        :type latency_window: int
+        :param session_timeout: seconds after which a session without requests is closed, None to keep sessions open
+        until they're deleted
+        :type session_timeout: float
+        :param acquire_timeout: seconds a request waits for a replica before getting 503, None to wait forever
+        :type acquire_timeout: float
+        """
+        self._pools = {name: ModelPool(path, replicas) for name, path in models.items()}
+        self._sessions = {}
+        self._session_timeout = session_timeout
+        self._acquire_timeout = acquire_timeout
+        self._expiry_task = None
+
+        self._workers = os.cpu_count() if workers is None else workers
+        self._executor = ThreadPoolExecutor(max_workers=self._workers)
+        self._slots = asyncio.Semaphore(self._workers)
+        self._server = None
+
+        """
+        Statistics: latencies in milliseconds of the last inference requests, number of requests and errors, requests
+        waiting for a replica or a worker and requests being propagated
+        """
+        self._latencies = deque(maxlen=latency_window)
+        self._requests = 0
+        self._errors = 0
+        self._waiting = 0
+        self._running = 0
+
+    async def start(self, host='127.0.0.1', port=8080):
+        """
+        Starts accepting connections
+
+        :type host: str
+        :param port: port to listen on, 0 to use a free port
+        :type port: int
+        :return: the port the server listens on
+        :rtype: int
+        """
+        self._server = await asyncio.start_server(self._handle_connection, host, port)
+        if self._session_timeout is not None:
+            self._expiry_task = asyncio.ensure_future(self._expire_sessions())
+        return self._server.sockets[0].getsockname()[1]
+
+    async def close(self):
+        """
+        Stops accepting connections and shuts down the workers
+
+        :return: None
+        """
+        if self._expiry_task is not None:
+            self._expiry_task.cancel()
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+        self._executor.shutdown()
+
+    async def _expire_sessions(self):
+        """
+        Closes the sessions that have been idle for longer than the session timeout, checking them periodically
+
+        :return: None
+        """
+        while True:
+            await asyncio.sleep(self._session_timeout / 4)
+            now = time.monotonic()
+            for session_id, session in list(self._sessions.items()):
+                # A session whose lock is taken is being used
+                if not session.lock.locked() and now - session.last_used > self._session_timeout:
+                    try:
+                        await self._close_session(session_id)
+                    except HTTPError:
+                        # Closed by a request in the meantime
+                        pass
+
+    def get_stats(self):
+        """
+        Returns the statistics of the server: number of requests and errors, requests waiting for a replica or a
+        worker(queue depth), requests being propagated, open sessions, available replicas and latency percentiles in
+        milliseconds
+
+        :rtype: dict
+        """
+        if len(self._latencies) != 0:
+            percentiles = np.percentile(list(self._latencies), [50, 90, 99])
+        else:
+            percentiles = [0, 0, 0]
+
+        return {
+            'requests': self._requests,
+            'errors': self._errors,
+            'queue_depth': self._waiting,
+            'running': self._running,
+            'workers': self._workers,
+            'sessions': len(self._sessions),
+            'replicas': {name: {'total': pool.replicas, 'available': pool.get_available()}
+                         for name, pool in self._pools.items()},
+            'latency_ms': {'p50': float(percentiles[0]), 'p90': float(percentiles[1]), 'p99': float(percentiles[2])}
+        }
+
+    async def _handle_connection(self, reader, writer):
+        """
+        Reads the requests of a connection and writes their responses, the connection is kept open for HTTP/1.1
+        clients unless they ask to close it
+
+        :type reader: asyncio.StreamReader
+        :type writer: asyncio.StreamWriter
+        :return: None
+        """
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                method, target, version = request_line.decode('latin-1').split()
+
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    key, _, value = line.decode('latin-1').partition(':')
+                    headers[key.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get('content-length', 0)))
+
+                status, payload = await self._dispatch(method, target, body)
+                data = json.dumps(payload).encode()
+                keep_alive = version == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+
+                writer.write(('HTTP/1.1 ' + str(status) + ' ' + STATUS_MESSAGES[status] + '\r\n'
+                              'Content-Type: application/json\r\n'
+                              'Content-Length: ' + str(len(data)) + '\r\n'
+                              'Connection: ' + ('keep-alive' if keep_alive else 'close') + '\r\n\r\n').encode()
+                             + data)
+                await writer.drain()
+
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    async def _dispatch(self, method, target, body):
+        """
+        Executes a request and returns the status and the JSON payload of the response
+
+        :type method: str
+        :type target: str
+        :type body: bytes
+        :rtype: tuple[int,dict]
+        """
+        path = [el for el in target.split('?')[0].split('/') if el != '']
+        self._requests += 1
+
+        try:
+            request = json.loads(body) if len(body) != 0 else {}
+            if not isinstance(request, dict):
+                raise HTTPError(400, "The body must be a JSON object")
+
+            if path == ['stats'] and method == 'GET':
+                return 200, self.get_stats()
+            if path == ['models'] and method == 'GET':
+                return 200, {name: {'replicas': pool.replicas, 'available': pool.get_available()}
+                             for name, pool in self._pools.items()}
+            if path == ['infer'] and method == 'POST':
+                return 200, await self._infer(request)
+            if path == ['sessions'] and method == 'POST':
+                return 200, await self._open_session(request)
+            if len(path) >= 2 and path[0] == 'sessions':
+                session = self._sessions.get(path[1])
+                if session is None:
+                    raise HTTPError(404, "Session not found")
+
+                if len(path) == 2 and method == 'DELETE':
+                    return 200, await self._close_session(path[1])
+                if path[2:] == ['evidence'] and method == 'POST':
+                    return 200, await self._session_evidence(session, request)
+                if path[2:] == ['reset'] and method == 'POST':
+                    async with session.lock:
+                        self._use_session(session)
+                        session.replica.reset()
+                    return 200, {}
+
+            raise HTTPError(404, "Unknown endpoint")
+        except HTTPError as e:
+            self._errors += 1
+            return e.status, {'error': str(e)}
+        except RuntimeError as e:
+            self._errors += 1
+            return 409, {'error': str(e)}
+        except (ValueError, AttributeError, TypeError) as e:
+            self._errors += 1
+            return 400, {'error': str(e)}
+
+    def _get_pool(self, request):
+        """
+        :type request: dict
+        :rtype: ModelPool
+        """
+        pool = self._pools.get(request.get('model'))
+        if pool is None:
+            raise HTTPError(404, "Model not found")
+        return pool
+
+    async def _infer(self, request):
+        """
+        Runs a request without session on a replica that is given back to the pool right after
+
+        :type request: dict
+        :rtype: dict
+        """
+        pool = self._get_pool(request)
+        start = time.perf_counter()
+        replica = await self._acquire(pool)
+
+        try:
+            return await self._propagate(replica, request, start)
+        finally:
+            pool.release(replica)
+
+    async def _acquire(self, pool):
+        """
+        Checks out a replica of a pool, the request fails with 503 if none is available within the acquire timeout
+
+        :type pool: ModelPool
+        :rtype: JunctionTree
+        """
+        self._waiting += 1
+        try:
+            return await pool.acquire(self._acquire_timeout)
+        except asyncio.TimeoutError:
+            raise HTTPError(503, "No replica of the model is available")
+        finally:
+            self._waiting -= 1
+
+    async def _open_session(self, request):
+        """
+        Checks out a replica for a new session
+
+        :type request: dict
+        :rtype: dict
+        """
+        pool = self._get_pool(request)
+        replica = await self._acquire(pool)
+
+        session_id = uuid.uuid4().hex
+        self._sessions[session_id] = Session(request['model'], replica)
+        return {'session': session_id}
+
+    async def _close_session(self, session_id):
+        """
+        Gives the replica of a session back to its pool, after the request being executed on it is done
+
+        :type session_id: str
+        :rtype: dict
+        """
+        session = self._sessions[session_id]
+        async with session.lock:
+            self._use_session(session)
+            session.closed = True
+            del self._sessions[session_id]
+            self._pools[session.model].release(session.replica)
+        return {}
+
+    @staticmethod
+    def _use_session(session):
+        """
+        Marks a session as used, to be called holding its lock. Raises 404 if the session was closed while the request
+        was waiting for it
+
+        :type session: Session
+        :return: None
+        """
+        if session.closed:
+            raise HTTPError(404, "Session not found")
+        session.last_used = time.monotonic()
+
+    async def _session_evidence(self, session, request):
+        """
+        Enters evidence on the replica of a session, on top of the evidence entered before
+
+        :type session: Session
+        :type request: dict
+        :rtype: dict
+        """
+        start = time.perf_counter()
+        async with session.lock:
+            self._use_session(session)
+            try:
+                return await self._propagate(session.replica, request, start)
+            finally:
+                session.last_used = time.monotonic()
+
+    async def _propagate(self, replica, request, start):
+        """
+        Enters the evidence of the request and computes its query in a worker thread, waiting for a free worker if
+        all of them are busy
+
+        :type replica: JunctionTree
+        :type request: dict
+        :param start: time the request started waiting, used for its latency
+        :type start: float
+        :rtype: dict
+        """
+        evidence = request.get('evidence', {})
+        query = request.get('query')
+
+        self._waiting += 1
+        try:
+            await self._slots.acquire()
+        finally:
+            self._waiting -= 1
+
+        self._running += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, _run_request, replica, evidence,
+                                                                    query)
+        finally:
+            self._running -= 1
+            self._slots.release()
+            self._latencies.append((time.perf_counter() - start) * 1000)
+
+
+def _run_request(replica, evidence, query):
+    """
+    Enters evidence on a replica, propagates it and returns the probabilities of the query variables. Runs in a worker
+    thread
+
+    :type replica: JunctionTree
+    :type evidence: dict[str,int or str or list[float]]
+    :param query: names of the variables to compute, all variables if None
+    :type query: list[str]
+    :rtype: dict
+    """
+    replica.set_evidence(evidence)
+    if query is None:
+        query = [variable.name for variable in replica.get_variables()]
+
+    return {
+        'marginals': {name: bnjt.get_marginal(replica, name) for name in query},
+        'evidence_probability': replica.get_evidence_probability()
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Local inference server for bayesian nets")
+    parser.add_argument('models', nargs='+', help="model files, as path or name=path, the name of a path is the name "
+                                                  "of the file without extension")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--replicas', type=int, default=2, help="JunctionTree replicas of each model")
+    parser.add_argument('--workers', type=int, help="maximum concurrent propagations, the number of cores by default")
+    parser.add_argument('--session-timeout', type=float, default=300, help="seconds after which idle sessions are "
+                                                                           "closed")
+    parser.add_argument('--acquire-timeout', type=float, default=30, help="seconds a request waits for a replica "
+                                                                          "before getting 503")
+    args = parser.parse_args(argv)
+
+    models = {}
+    for el in args.models:
+        name, _, path = el.rpartition('=')
+        if name == '':
+            name = os.path.splitext(os.path.basename(path))[0]
+        models[name] = path
+
+    async def serve():
+        server = InferenceServer(models, args.replicas, args.workers, session_timeout=args.session_timeout,
+                                 acquire_timeout=args.acquire_timeout)
+        port = await server.start(args.host, args.port)
+        print("Listening on " + args.host + ":" + str(port))
+        try:
+            await asyncio.Event().wait()
+        finally:
+            await server.close()
+
+    try:
+        asyncio.run(serve())
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
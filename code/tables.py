@@ -1,7 +1,11 @@
 #
 # This file contains the structure for belief tables and the operations that can be executed on them,as well as
-# the random variables Variable
+# the random variables Variable, their registry and the cache for the plans of table operations
 #
+import heapq
+import threading
+from collections import OrderedDict
+
 import numpy as np
 
 import util
@@ -55,31 +59,11 @@ class BeliefTable(object):
         :rtype: BeliefTable
         """
 
-        # Merge all variables
-        new_variables = {**self._variables, **t2._variables}
-        new_variables = dict.fromkeys(sorted(new_variables.keys()))
-
-        # Create empty table
-        new_shape = util.get_shape_from_var_dict(new_variables)
-        new_table = np.empty(new_shape)
-
-        for index, value in np.ndenumerate(new_table):
-            # Find the corresponding indexes in the 2 multiplying terms
-            # For example: t_{A,B}*t_{A,C}=t_{A,B,C}
-            # the element in position (a0,b0,c1) in the result is the product of the elements in positions
-            # (a0,b0) and in position (b0,c1)
-            dict_1_proxy = dict.fromkeys(self._variables)
-            dict_2_proxy = dict.fromkeys(t2._variables)
-
-            i = 0
-            for variable in list(new_variables.keys()):
-                if variable in dict_1_proxy.keys():
-                    dict_1_proxy[variable] = index[i]
-                if variable in dict_2_proxy.keys():
-                    dict_2_proxy[variable] = index[i]
-                i += 1
+        new_variables, alignment_1, alignment_2 = self._get_binary_plan(t2)
 
-            new_table[index] = self._table[tuple(dict_1_proxy.values())] * t2._table[tuple(dict_2_proxy.values())]
+        # Align both tables to the order of the result and let numpy broadcast the product
+        # For example: t_{A,B}*t_{A,C}=t_{A,B,C} is computed as t_{A,B,1}*t_{A,1,C}
+        new_table = np.multiply(self._get_aligned_table(alignment_1), t2._get_aligned_table(alignment_2), dtype=float)
 
         return BeliefTable(new_variables, new_table)
 
@@ -93,31 +77,15 @@ class BeliefTable(object):
         :return: the result of the division
         :rtype: BeliefTable
         """
-        # Merge all variables
-        new_variables = {**self._variables, **t2._variables}
-        new_variables = dict.fromkeys(sorted(new_variables.keys()))
+        new_variables, alignment_1, alignment_2 = self._get_binary_plan(t2)
 
-        # Create empty table
-        new_shape = util.get_shape_from_var_dict(new_variables)
-        new_table = np.empty(new_shape)
+        dividend = self._get_aligned_table(alignment_1)
+        divider = t2._get_aligned_table(alignment_2)
 
-        for index, value in np.ndenumerate(new_table):
-            # Find the corresponding indexes in the 2 multiplying terms
-            dict_1_proxy = dict.fromkeys(self._variables)
-            dict_2_proxy = dict.fromkeys(t2._variables)
-            i = 0
-            for variable in list(new_variables.keys()):
-                if variable in dict_1_proxy.keys():
-                    dict_1_proxy[variable] = index[i]
-                if variable in dict_2_proxy.keys():
-                    dict_2_proxy[variable] = index[i]
-                i += 1
-
-            if self._table[tuple(dict_1_proxy.values())] == 0:
-                # Make it so 0/anything is 0(No NaN problems)
-                new_table[index] = 0
-            else:
-                new_table[index] = self._table[tuple(dict_1_proxy.values())] / t2._table[tuple(dict_2_proxy.values())]
+        # Make it so 0/anything is 0(No NaN problems): masked entries are never divided and keep the 0 of the output
+        new_table = np.zeros(util.get_shape_from_var_dict(new_variables))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            np.divide(dividend, divider, out=new_table, where=(dividend != 0))
 
         return BeliefTable(new_variables, new_table)
 
@@ -132,41 +100,201 @@ class BeliefTable(object):
         :return: the marginalized table
         :rtype: BeliefTable
         """
-        new_variables = dict.fromkeys(sorted(new_variables))
-        if not (new_variables.keys() < self._variables.keys()):
-            raise AttributeError("Variables to marginalize on must be a subset of variables of the table")
+        key = ('marginalize', tuple(self._variables), tuple(new_variables))
+        new_variables, own_shape, sum_axes, permutation = plan_cache.get(key, self._build_marginalize_plan,
+                                                                         new_variables)
 
-        new_shape = util.get_shape_from_var_dict(new_variables)
-        new_table = np.zeros(tuple(new_shape))
+        # Sum over the axes of the variables in V\W: marginalizing on AC over t_ABC means summing over the B axis, then
+        # sort the remaining axes like the new variables
+        new_table = np.sum(np.reshape(self._table, own_shape), axis=sum_axes, dtype=float)
+        new_table = np.transpose(new_table, permutation)
 
-        sum_variables = util.subtract_ordered_dict(self._variables, new_variables)
-        sum_shape = util.get_shape_from_var_dict(sum_variables)
-        sum_entries = util.shape_to_list_of_entries(sum_shape)
+        return BeliefTable(new_variables, new_table)
 
-        # Create template for indexing, setting up which variables have to be extracted whole :
-        # Marginalizing on AB over t_ABC means summing (:,:,c0) + (:,:,c1) +... (that is over C values)
-        coord_template = []
-        for el in self._variables:
-            if el in new_variables:
-                coord_template.append(slice(None))
-            else:
-                coord_template.append(0)
+    def multiply_table_in_place(self, t2):
+        """
+        Multiplies the BeliefTable by t2 without allocating a new table, the variables of t2 must be a subset of the
+        variables of this table. e.g. t_{A,B,C} *= t_{C,A}
 
-        # Iterate over all possible values of V\W
-        for entry in sum_entries:
-            actual_coord = coord_template.copy()
+        :param t2: The second multiplication term
+        :type t2: BeliefTable
+        :return: None
+        """
+        alignment = self._get_in_place_alignment(t2)
+        self._ensure_float()
+        self._table *= t2._get_aligned_table(alignment)
 
-            # Find the subtable by substituting the non ':' places in the index template with actual indexes
-            index = 0
-            for ind, element in enumerate(actual_coord):
-                if element != slice(None):
-                    actual_coord[ind] = entry[index]
-                    index += 1
+    def copy_table_from(self, t2):
+        """
+        Overwrites the entries of the BeliefTable with those of t2, that must have the same variables in any order
 
-            # Add each table
-            new_table += self.get_prob(tuple(actual_coord))
+        :type t2: BeliefTable
+        :return: None
+        """
+        if self._variables.keys() != t2._variables.keys():
+            raise AttributeError("The tables must have the same variables")
 
-        return BeliefTable(new_variables, new_table)
+        alignment = self._get_in_place_alignment(t2)
+        self._ensure_float()
+        self._table[...] = t2._get_aligned_table(alignment)
+
+    def invert(self):
+        """
+        Returns the table with the reciprocal of each entry, entries equal to 0 stay 0 so that multiplying by the
+        inverted table behaves like divide_table
+
+        :rtype: BeliefTable
+        """
+        new_table = np.zeros(util.get_shape_from_var_dict(self._variables))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            np.divide(1, self._table, out=new_table, where=(self._table != 0))
+
+        return BeliefTable(self._variables.copy(), new_table)
+
+    @staticmethod
+    def contract(tables, keep_vars):
+        """
+        Multiplies all the given BeliefTables and marginalizes the product on keep_vars, without building the table of
+        the whole product: t_W = sum_{V-W} prod_i t_i
+        The tables are multiplied two at a time, always choosing the pair whose (partially marginalized) result is the
+        smallest, and each variable is summed out as soon as no other table and no variable in keep_vars needs it.
+
+        :param tables: tables to multiply
+        :type tables: list[BeliefTable]
+        :param keep_vars: variables of the result, must be a subset of the variables of the tables
+        :type keep_vars: dict[Variable,None] or list[Variable]
+        :return: the marginalized product
+        :rtype: BeliefTable
+        """
+        keep_vars = dict.fromkeys(sorted(keep_vars))
+        if len(tables) == 0:
+            raise AttributeError("At least one table is needed")
+
+        operands = {k: (list(t.get_variables().keys()),
+                        np.reshape(t._table, util.get_shape_from_var_dict(t.get_variables())))
+                    for k, t in enumerate(tables)}
+
+        # Operands that contain each variable, kept updated as operands are merged
+        var_ops = {}
+        for k, (op_vars, _) in operands.items():
+            for el in op_vars:
+                var_ops.setdefault(el, set()).add(k)
+        if not keep_vars.keys() <= var_ops.keys():
+            raise AttributeError("Variables to keep must be a subset of the variables of the tables")
+
+        # Candidate pairs are the operands that share a variable, in a heap ordered by the size of their result. Every
+        # operand has a version that changes when its surviving variables may change, so stale pairs are skipped
+        versions = dict.fromkeys(operands, 0)
+        heap = []
+        for k in list(operands):
+            BeliefTable._push_contraction_pairs(heap, operands, var_ops, versions, k, keep_vars)
+
+        next_key = len(operands)
+        while len(operands) > 1:
+            # Choose the pair that yields the smallest intermediate table
+            pair = None
+            while len(heap) != 0:
+                _, i, j, version_i, version_j = heapq.heappop(heap)
+                if versions.get(i) == version_i and versions.get(j) == version_j:
+                    pair = (i, j)
+                    break
+            if pair is None:
+                # No operands share a variable, the smallest ones are multiplied first
+                pair = sorted(operands, key=lambda k: util.get_size_from_var_dict(
+                    [el for el in operands[k][0] if el in keep_vars]))[:2]
+
+            i, j = pair
+            result_vars = BeliefTable._get_contraction_vars(operands, var_ops, i, j, keep_vars)
+            vars_i, table_i = operands.pop(i)
+            vars_j, table_j = operands.pop(j)
+            del versions[i], versions[j]
+
+            new_key = next_key
+            next_key += 1
+            operands[new_key] = (result_vars,
+                                 BeliefTable._einsum([(vars_i, table_i), (vars_j, table_j)], result_vars))
+            versions[new_key] = 0
+
+            # Update the operands of the merged variables, those summed out disappear
+            touched = set()
+            for el in dict.fromkeys(vars_i + vars_j):
+                var_ops[el].discard(i)
+                var_ops[el].discard(j)
+                if el in result_vars:
+                    var_ops[el].add(new_key)
+                touched.update(var_ops[el])
+
+            # Only the pairs of the operands that contain one of the merged variables change their result
+            for k in touched:
+                versions[k] += 1
+            for k in touched:
+                BeliefTable._push_contraction_pairs(heap, operands, var_ops, versions, k, keep_vars)
+
+        # Sum out what is left and sort the result like the variables to keep
+        new_table = BeliefTable._einsum(list(operands.values()), list(keep_vars.keys()))
+        return BeliefTable(keep_vars, np.asarray(new_table, dtype=float))
+
+    @staticmethod
+    def _push_contraction_pairs(heap, operands, var_ops, versions, k, keep_vars):
+        """
+        Pushes in the heap the pairs made by operand k and each operand that shares a variable with it, with the size
+        of the result of their contraction
+
+        :type heap: list[tuple]
+        :type operands: dict[int,tuple[list[Variable],np.ndarray]]
+        :type var_ops: dict[Variable,set[int]]
+        :type versions: dict[int,int]
+        :type k: int
+        :type keep_vars: dict[Variable,None]
+        :return: None
+        """
+        partners = set()
+        for el in operands[k][0]:
+            partners.update(var_ops[el])
+        partners.discard(k)
+
+        for m in partners:
+            i, j = min(k, m), max(k, m)
+            size = util.get_size_from_var_dict(BeliefTable._get_contraction_vars(operands, var_ops, i, j, keep_vars))
+            heapq.heappush(heap, (size, i, j, versions[i], versions[j]))
+
+    @staticmethod
+    def _get_contraction_vars(operands, var_ops, i, j, keep_vars):
+        """
+        Returns the variables of the product of operands i and j that must survive the contraction, that is those that
+        have to be kept or that appear in any other operand
+
+        :type operands: dict[int,tuple[list[Variable],np.ndarray]]
+        :param var_ops: the operands that contain each variable
+        :type var_ops: dict[Variable,set[int]]
+        :type i: int
+        :type j: int
+        :type keep_vars: dict[Variable,None]
+        :rtype: list[Variable]
+        """
+        pair_vars = dict.fromkeys(operands[i][0] + operands[j][0])
+
+        return [el for el in pair_vars
+                if el in keep_vars or len(var_ops[el]) - (i in var_ops[el]) - (j in var_ops[el]) > 0]
+
+    @staticmethod
+    def _einsum(operands, result_vars):
+        """
+        Sum of products of the given operands over all variables not in result_vars, computed by np.einsum without
+        materializing the full product
+
+        :type operands: list[tuple[list[Variable],np.ndarray]]
+        :type result_vars: list[Variable]
+        :rtype: np.ndarray
+        """
+        labels = {}
+        arguments = []
+        for op_vars, table in operands:
+            arguments.append(table)
+            arguments.append([labels.setdefault(el, len(labels)) for el in op_vars])
+        arguments.append([labels[el] for el in result_vars])
+
+        return np.einsum(*arguments)
 
     def multiply_all(self, value):
         """
@@ -186,6 +314,105 @@ class BeliefTable(object):
         """
         self._table /= value
 
+    def _get_binary_plan(self, t2):
+        """
+        Returns the plan of a multiplication/division between this table and t2: the variables of the result, sorted,
+        and the alignment of both terms to them. Plans are cached by the order of the variables of both terms.
+
+        :type t2: BeliefTable
+        :rtype: tuple[tuple[Variable],tuple,tuple]
+        """
+        key = ('binary', tuple(self._variables), tuple(t2._variables))
+        return plan_cache.get(key, BeliefTable._build_binary_plan, self._variables, t2._variables)
+
+    @staticmethod
+    def _build_binary_plan(variables_1, variables_2):
+        """
+        Merges the variables of two tables and computes how each table is aligned to the merged variables
+
+        :type variables_1: dict[Variable,None]
+        :type variables_2: dict[Variable,None]
+        :rtype: tuple[tuple[Variable],tuple,tuple]
+        """
+        new_variables = tuple(sorted({**variables_1, **variables_2}.keys()))
+
+        return (new_variables, BeliefTable._build_alignment(variables_1, new_variables),
+                BeliefTable._build_alignment(variables_2, new_variables))
+
+    @staticmethod
+    def _build_alignment(variables, new_variables):
+        """
+        Computes how a table over variables is made broadcastable against a table over new_variables: the axes are
+        transposed to follow the order of new_variables and a singleton axis is inserted for each missing variable.
+        e.g. t_{C,A} aligned to (A,B,C) becomes a table of shape (|A|,1,|C|)
+        Returns the shape of the table, the permutation of its axes and the aligned shape
+
+        :param variables: variables of the table
+        :type variables: dict[Variable,None] or list[Variable]
+        :param new_variables: ordered superset of the variables of the table
+        :type new_variables: dict[Variable,None] or list[Variable] or tuple[Variable]
+        :rtype: tuple[tuple[int],list[int],tuple[int]]
+        """
+        own_variables = list(variables)
+        permutation = [own_variables.index(el) for el in new_variables if el in variables]
+        aligned_shape = tuple(el.get_cardinality() if el in variables else 1 for el in new_variables)
+
+        return util.get_shape_from_var_dict(own_variables), permutation, aligned_shape
+
+    def _get_aligned_table(self, alignment):
+        """
+        Returns a view of the numpy table, transposed and reshaped according to an alignment built by _build_alignment
+
+        :type alignment: tuple[tuple[int],list[int],tuple[int]]
+        :rtype: np.ndarray
+        """
+        own_shape, permutation, aligned_shape = alignment
+        return np.transpose(np.reshape(self._table, own_shape), permutation).reshape(aligned_shape)
+
+    def _get_in_place_alignment(self, t2):
+        """
+        Returns the alignment of t2 to the variables of this table, used by the operations that write their result in
+        this table. Like binary plans, the alignments are cached by the order of the variables of both tables
+
+        :type t2: BeliefTable
+        :rtype: tuple[tuple[int],list[int],tuple[int]]
+        """
+        if not (t2._variables.keys() <= self._variables.keys()):
+            raise AttributeError("The variables of the second table must be a subset of the variables of the first")
+
+        key = ('in_place', tuple(self._variables), tuple(t2._variables))
+        return plan_cache.get(key, BeliefTable._build_alignment, t2._variables, tuple(self._variables))
+
+    def _ensure_float(self):
+        """
+        Converts the numpy table to floats if it's not, so that in place operations don't truncate their results
+
+        :return: None
+        """
+        if self._table.dtype != float:
+            self._table = self._table.astype(float)
+
+    def _build_marginalize_plan(self, new_variables):
+        """
+        Computes the variables of the marginalized table, the axes to sum over and the permutation that sorts the
+        remaining axes like the new variables
+
+        :type new_variables: dict[Variable,None] or list[Variable]
+        :rtype: tuple[tuple[Variable],tuple[int],tuple[int],list[int]]
+        """
+        new_variables = dict.fromkeys(sorted(new_variables))
+        if not (new_variables.keys() <= self._variables.keys()):
+            raise AttributeError("Variables to marginalize on must be a subset of variables of the table")
+
+        own_variables = list(self._variables.keys())
+        sum_axes = tuple(i for i, el in enumerate(own_variables) if el not in new_variables)
+
+        # The remaining axes keep the order they had in the table
+        remaining_variables = [el for el in own_variables if el in new_variables]
+        permutation = [remaining_variables.index(el) for el in new_variables]
+
+        return tuple(new_variables), util.get_shape_from_var_dict(own_variables), sum_axes, permutation
+
     def _get_variable_index(self, variable):
         """
         Returns the index of the given variable in the variable "list"(it's still an ordered set)
@@ -382,6 +609,8 @@ class Variable(object):
     Class that represents a variable and the values it can take
     """
 
+    __slots__ = ('name', 'label', 'values', '_value_index', '_id', '_hash')
+
     def __init__(self, name, label, values):
         """
         Initializes a variable with the given name,label and values. Only use alphanumeric values for the name and values
@@ -411,6 +640,33 @@ class Variable(object):
         if not all(isinstance(x, first_type) for x in value_list):
             raise AttributeError("The value list can't contain  both integers and strings")
 
+        self._register()
+
+    def _register(self):
+        """
+        Gets the id of the variable from the registry and precomputes its hash and the index of each of its values
+
+        :return: None
+        """
+        """
+        Dictionary that maps each value of the variable to its index in the set of values
+        """
+        self._value_index = {value: index for index, value in enumerate(self.values)}
+
+        """
+        Integer id of the variable, shared by all Variables with the same name and values
+        """
+        self._id = variable_registry.get_id(self.name, self.values)
+        self._hash = hash(self._id)
+
+    def get_id(self):
+        """
+        Returns the integer id the registry assigned to the variable
+
+        :rtype: int
+        """
+        return self._id
+
     def get_cardinality(self):
         """
         Returns the number of values a variable can take
@@ -429,9 +685,10 @@ class Variable(object):
         """
         if isinstance(value, str):
             value = value.lower()
-        if value not in self.values:
+        index = self._value_index.get(value)
+        if index is None:
             raise AttributeError("Value not valid for the given variable")
-        return list(self.values.keys()).index(value)
+        return index
 
     def is_valid(self, value):
         """
@@ -452,7 +709,8 @@ class Variable(object):
         if not isinstance(other, Variable):
             return AttributeError("Wrong comparison types")
 
-        return self.name == other.name and self.values == other.values
+        # Variables with the same name and values share the same id
+        return self._id == other._id
 
     def __str__(self):
         stringed_var = self.name + "(" + self.label + ") :"
@@ -474,6 +732,126 @@ class Variable(object):
         return Variable(copied_name, copied_label, copied_values)
 
     def __hash__(self):
-        # frozenset is an immutable representation of a set/dict; hashing it is much faster and safer than hashing a
-        # dict
-        return hash((self.name, frozenset(self.values)))
+        return self._hash
+
+    def __getstate__(self):
+        # The id depends on the registry of the running process, so it's not saved
+        return {'name': self.name, 'label': self.label, 'values': self.values}
+
+    def __setstate__(self, state):
+        self.name = state['name']
+        self.label = state['label']
+        self.values = state['values']
+        self._register()
+
+
+class VariableRegistry(object):
+    """
+    Registry that assigns a stable integer id to each variable, two Variables with the same name and values get the
+    same id
+    """
+
+    def __init__(self):
+        """
+        Dictionary that maps (name, frozenset of values) to the id of the variable
+        """
+        self._ids = {}
+
+    def get_id(self, name, values):
+        """
+        Returns the id of the variable with the given name and values, registering it if it's new
+
+        :type name: string
+        :type values: dict[string or int, None]
+        :rtype: int
+        """
+        # frozenset is an immutable representation of a set/dict, the order of the values doesn't matter
+        return self._ids.setdefault((name, frozenset(values)), len(self._ids))
+
+    def __len__(self):
+        return len(self._ids)
+
+
+class PlanCache(object):
+    """
+    Bounded LRU cache for the plans of BeliefTable operations (merged variables, transpose permutations, broadcast
+    shapes and reduction axes). Plans only depend on the ordered variables of the operands, so in a JunctionTree the
+    same plans are reused by every propagation.
+    """
+
+    def __init__(self, maxsize=1024):
+        """
+        :param maxsize: maximum number of plans kept in the cache
+        :type maxsize: int
+        """
+        self.maxsize = maxsize
+
+        """
+        Ordered dictionary of plans, the least recently used one is the first
+        """
+        self._plans = OrderedDict()
+
+        """
+        Lock that makes the operations on the plans atomic, the cache is shared by the threads that propagate
+        """
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, build, *args):
+        """
+        Returns the plan stored for the given key, if it's not in the cache it's computed as build(*args) and stored
+
+        :type key: tuple
+        :param build: function that computes the plan
+        :type build: function
+        :return: the plan
+        """
+        with self._lock:
+            plan = self._plans.get(key)
+            if plan is not None:
+                self.hits += 1
+                self._plans.move_to_end(key)
+                return plan
+            self.misses += 1
+
+        # Plans don't depend on the cache, so they are built without holding the lock
+        plan = build(*args)
+        with self._lock:
+            self._plans[key] = plan
+            while len(self._plans) > self.maxsize:
+                self._plans.popitem(last=False)
+
+        return plan
+
+    def clear(self):
+        """
+        Empties the cache and resets the counters
+
+        :return: None
+        """
+        with self._lock:
+            self._plans.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def info(self):
+        """
+        Returns the statistics of the cache
+
+        :rtype: dict[str,int]
+        """
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'maxsize': self.maxsize, 'size': len(self._plans)}
+
+
+"""
+Registry shared by all Variables
+"""
+variable_registry = VariableRegistry()
+
+"""
+Plan cache shared by all BeliefTables
+"""
+plan_cache = PlanCache()
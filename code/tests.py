@@ -1,11 +1,33 @@
+import asyncio
+import http.client
+import io
+import json
+import os
+import pickle
+import tempfile
+import threading
+import time
 import unittest
+import warnings
+from unittest import mock
 
 import numpy as np
 
+import bnjt
+import models
+import server
+import triangulation
+import util
+from batch import BatchJunctionTree
+from batch import batch_infer
 from bayes_nets import BayesianNet
 from bayes_nets import JunctionTree
+from bayes_nets import PosteriorCache
+from server import InferenceServer
 from tables import BeliefTable
+from tables import PlanCache
 from tables import Variable
+from tables import plan_cache
 
 
 class TableTests(unittest.TestCase):
@@ -64,6 +86,50 @@ class TableTests(unittest.TestCase):
         self.assertEqual(res.get_prob((1, 1, 0)), 6)
         self.assertEqual(res.get_prob((1, 1, 1)), 9)
 
+        # Multiplication with unsorted variables and more than 2 values
+        D = Variable('D', 'D', [0, 1, 2])
+        b1 = BeliefTable([D, self.A], np.arange(6).reshape(3, 2))
+        b2 = BeliefTable([self.B, D], np.arange(6).reshape(2, 3))
+
+        res = b1.multiply_table(b2)
+        self.assertEqual(res.get_variable_names(), ['A', 'B', 'D'])
+        for a in range(2):
+            for b in range(2):
+                for d in range(3):
+                    self.assertEqual(res.get_prob((a, b, d)), b1.get_prob((d, a)) * b2.get_prob((b, d)))
+
+    def test_division(self):
+        b1 = BeliefTable([self.A, self.B], np.array([[0., 2.], [0., 3.]]))
+        b2 = BeliefTable([self.B], np.array([0., 4.]))
+
+        # 0/0 must give 0 without raising warnings
+        with warnings.catch_warnings():
+            warnings.simplefilter('error')
+            res = b1.divide_table(b2)
+
+        self.assertEqual(res.get_prob((0, 0)), 0)
+        self.assertEqual(res.get_prob((0, 1)), 0.5)
+        self.assertEqual(res.get_prob((1, 0)), 0)
+        self.assertEqual(res.get_prob((1, 1)), 0.75)
+
+    def test_in_place_operations(self):
+        b1 = BeliefTable([self.A, self.B], np.arange(4).reshape(2, 2))
+        b2 = BeliefTable([self.B, self.A], np.array([[1., 2.], [3., 4.]]))
+        b3 = BeliefTable([self.B], np.array([2., 0.5]))
+        array = b2.get_prob(Ellipsis)
+
+        # The variables keep their order
+        b2.multiply_table_in_place(b3)
+        self.assertTrue(np.shares_memory(b2.get_prob(Ellipsis), array))
+        self.assertTrue(np.array_equal(b2.get_prob(Ellipsis), [[2., 4.], [1.5, 2.]]))
+
+        # Integer tables are converted instead of truncating the result
+        b1.copy_table_from(b2)
+        self.assertTrue(np.array_equal(b1.get_prob(Ellipsis), [[2., 1.5], [4., 2.]]))
+
+        self.assertRaises(AttributeError, b3.multiply_table_in_place, b2)
+        self.assertRaises(AttributeError, b1.copy_table_from, b3)
+
     def test_marginalization(self):
         # Check that it doesn't allow marginalization on sets greater than the variables of the table
         dict1 = dict.fromkeys([self.A])
@@ -111,6 +177,21 @@ class TableTests(unittest.TestCase):
         self.assertEqual(t2.get_prob((1, 0)), 10)
         self.assertEqual(t2.get_prob((1, 1)), 12)
 
+        # Test marginalization of a table whose variables are not sorted
+        dict1 = dict.fromkeys([self.C, self.B, self.A])
+        dict2 = dict.fromkeys([self.C, self.A])
+
+        arr1 = np.arange(8).reshape((2, 2, 2))
+
+        t1 = BeliefTable(dict1, arr1)
+        t2 = t1.marginalize(dict2)
+
+        self.assertEqual(t2.get_variable_names(), ['A', 'C'])
+        self.assertEqual(t2.get_prob((0, 0)), 2)
+        self.assertEqual(t2.get_prob((0, 1)), 10)
+        self.assertEqual(t2.get_prob((1, 0)), 4)
+        self.assertEqual(t2.get_prob((1, 1)), 12)
+
     def test_multiply_and_marginalize(self):
         # A reasonably big case I spent 30 minutes writing on paper, uses both multiplication and marginalization
         D = Variable('D', 'D', [0, 1])
@@ -140,6 +221,92 @@ class TableTests(unittest.TestCase):
         self.assertAlmostEqual(t5.get_prob(0), 0.75)
         self.assertAlmostEqual(t5.get_prob(1), 0.25)
 
+        # Same result without building the product
+        t6 = BeliefTable.contract([t1, t2, t3, t4], holes)
+        self.assertAlmostEqual(t6.get_prob(0), 0.75)
+        self.assertAlmostEqual(t6.get_prob(1), 0.25)
+
+        t7 = BeliefTable.contract([t1, t2, t3, t4], [S, D])
+        t8 = t1.multiply_table(t2).multiply_table(t3).multiply_table(t4).marginalize([S, D])
+        self.assertEqual(t7.get_variable_names(), t8.get_variable_names())
+        self.assertTrue(np.allclose(t7.get_prob(slice(None)), t8.get_prob(slice(None))))
+
+        # Tables that share no variable are multiplied too
+        t9 = BeliefTable.contract([t2, t3, BeliefTable([L], np.array([0.4, 0.6]))], [D, L])
+        t10 = t2.multiply_table(t3).multiply_table(BeliefTable([L], np.array([0.4, 0.6]))).marginalize([D, L])
+        self.assertEqual(t9.get_variable_names(), t10.get_variable_names())
+        self.assertTrue(np.allclose(t9.get_prob(slice(None)), t10.get_prob(slice(None))))
+
+    def test_plan_cache(self):
+        b1 = BeliefTable([self.B, self.A], np.arange(4).reshape(2, 2))
+        b2 = BeliefTable([self.C, self.A], np.arange(4).reshape(2, 2))
+
+        plan_cache.clear()
+        first = b1.multiply_table(b2).marginalize([self.A])
+        self.assertEqual(plan_cache.info()['misses'], 2)
+        self.assertEqual(plan_cache.info()['hits'], 0)
+
+        second = b1.multiply_table(b2).marginalize([self.A])
+        self.assertEqual(plan_cache.info()['misses'], 2)
+        self.assertEqual(plan_cache.info()['hits'], 2)
+        self.assertTrue(np.array_equal(first.get_prob(slice(None)), second.get_prob(slice(None))))
+
+        # Least recently used plans are evicted
+        cache = PlanCache(maxsize=2)
+        cache.get(1, lambda: 'a')
+        cache.get(2, lambda: 'b')
+        cache.get(1, lambda: 'a')
+        cache.get(3, lambda: 'c')
+        self.assertEqual(cache.get(2, lambda: 'new b'), 'new b')
+        self.assertEqual(cache.info(), {'hits': 1, 'misses': 4, 'maxsize': 2, 'size': 2})
+
+        # Threads that share the cache don't evict a plan while another thread is reading it
+        class SlowPlans(type(cache._plans)):
+            def get(self, key, default=None):
+                plan = super().get(key, default)
+                threading.Event().wait(0.001)
+                return plan
+
+        cache = PlanCache(maxsize=2)
+        cache._plans = SlowPlans()
+        errors = []
+
+        def use_cache(keys):
+            try:
+                for key in keys * 20:
+                    cache.get(key, lambda: key)
+            except KeyError as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=use_cache, args=([i, i + 1, i + 2],)) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(cache.info()['size'], 2)
+
+    def test_variable_registry(self):
+        # Same name and values, even in a different order, means same variable
+        A1 = Variable('A', 'First label', ['x', 'y', 'z'])
+        A2 = Variable('A', 'Second label', ['Z', 'Y', 'X'])
+        A3 = Variable('A', 'A', ['x', 'y'])
+
+        self.assertEqual(A1.get_id(), A2.get_id())
+        self.assertNotEqual(A1.get_id(), A3.get_id())
+        self.assertEqual(A1, A2)
+        self.assertEqual(hash(A1), hash(A2))
+        self.assertNotEqual(A1, A3)
+
+        self.assertEqual(A1.get_value_index('Z'), 2)
+        self.assertEqual(A2.get_value_index('z'), 0)
+        self.assertRaises(AttributeError, A1.get_value_index, 'w')
+
+        # The id is restored when unpickling
+        copied = pickle.loads(pickle.dumps(A1))
+        self.assertEqual(copied.get_id(), A1.get_id())
+        self.assertEqual(copied.label, 'First label')
+
 
 class BayesianNetTests(unittest.TestCase):
 
@@ -162,6 +329,26 @@ class BayesianNetTests(unittest.TestCase):
         net.add_variable(self.A)
         self.assertRaises(AttributeError, net.add_variable, self.A)
 
+    def test_dependencies(self):
+        net = BayesianNet()
+        net.add_variable(self.C)
+        net.add_variable(self.B)
+        net.add_variable(self.A)
+
+        # C depends on B and B depends on A, which is against the order the variables were added in
+        net.add_dependence('C', 'B')
+        net.add_dependence('B', 'A')
+        net.add_dependence('C', 'A')
+
+        self.assertEqual(net.get_fathers(self.C), [self.B, self.A])
+        self.assertEqual(net.get_fathers(self.A), [])
+        self.assertEqual(net.get_topological_order(), [self.A, self.B, self.C])
+
+        # Links that would create a cycle are refused
+        self.assertRaises(AttributeError, net.add_dependence, 'A', 'C')
+        self.assertRaises(AttributeError, net.add_dependence, 'A', 'A')
+        self.assertEqual(net.get_fathers(self.A), [])
+
     def test_table_assignment(self):
         # Check if assigning tables via identifiers works correctly even when the order of variables is wrong
         S = Variable('S', 'S', [0, 1])
@@ -231,6 +418,472 @@ class JunctionTreeTest(unittest.TestCase):
         jtree.set_variable_chosen_clique('D', ['S', 'D', 'L'])
         jtree.set_variable_chosen_clique('L', ['S', 'D', 'L'])
 
+    def test_lookups(self):
+        jtree = JunctionTree([self.S, self.D, self.H, self.L])
+        jtree.add_clique(['S', 'H'])
+        jtree.add_clique(['L', 'D', 'S'])
+        jtree.add_clique(['H', 'L'])
+        jtree.connect_cliques(['S', 'H'], ['S', 'D', 'L'])
+        jtree.connect_cliques(['L', 'H'], ['H', 'S'])
+
+        self.assertIs(jtree.get_variable_by_name('L'), self.L)
+        self.assertRaises(AttributeError, jtree.get_variable_by_name, 'X')
+
+        # Cliques and separators are found whatever the order of their variables
+        clique = jtree.get_clique(['D', 'L', 'S'])
+        self.assertIs(jtree.get_clique_from_dict([self.S, self.L, self.D]), clique)
+        self.assertIsNone(jtree.get_clique_from_dict([self.S, self.D]))
+        self.assertRaises(AttributeError, jtree.get_clique, ['S', 'D'])
+        self.assertIn(jtree.get_separator(['S']), clique.get_neighbours())
+        self.assertIs(jtree.get_separator_from_dict([self.H]), jtree.get_separator(['H']))
+
+        # Lookups still work on trees loaded from file
+        loaded = pickle.loads(pickle.dumps(jtree))
+        self.assertEqual(loaded.get_clique(['D', 'L', 'S']).node_vars_to_string(), clique.node_vars_to_string())
+
+    def test_propagation_schedule(self):
+        jtree = JunctionTree([self.S, self.D, self.H, self.L])
+        jtree.add_clique(['S', 'H'])
+        jtree.add_clique(['S', 'D', 'L'])
+        jtree.add_clique(['H', 'L'])
+        jtree.connect_cliques(['S', 'H'], ['S', 'D', 'L'])
+
+        root = jtree.get_clique(['S', 'H'])
+        schedule = jtree.get_propagation_schedule(root)
+        self.assertEqual(len(schedule), 1)
+        parent, separator, child = schedule[0]
+        self.assertIs(parent, root)
+        self.assertIs(separator, jtree.get_separator(['S']))
+        self.assertIs(child, jtree.get_clique(['S', 'D', 'L']))
+
+        # The schedule is reused until the structure changes
+        self.assertIs(jtree.get_propagation_schedule(root), schedule)
+        jtree.connect_cliques(['S', 'H'], ['H', 'L'])
+        schedule = jtree.get_propagation_schedule(root)
+        self.assertEqual([c.node_vars_to_string() for _, _, c in schedule], ['S.D.L', 'H.L'])
+
+    def test_single_pass_collect(self):
+        net, jtree = models.build_studfarm()
+        jtree.initialize_tables(net)
+
+        # Evidence in two leaves of the tree, each edge on their paths to the root is absorbed once
+        jtree.add_evidence('L', 'carrier')
+        jtree.add_evidence('C', 'pure')
+        root = jtree.get_cliques_and_seps()[0][0]
+        with mock.patch.object(JunctionTree, '_absorb', wraps=JunctionTree._absorb) as absorb:
+            jtree.collect_evidence(root)
+        senders = [call.args[0].node_vars_to_string() for call in absorb.call_args_list]
+        self.assertEqual(len(senders), len(set(senders)))
+        self.assertEqual(sorted(senders), sorted(['A.F.L', 'A.D.F.H', 'A.B.D.H', 'B.C.E', 'B.E.G.I', 'A.B.G.I',
+                                                  'A.B.H.I']))
+        self.assertTrue(root.received_evidence)
+
+        jtree.distribute_evidence(root)
+        root.received_evidence = False
+        jtree.sum_propagate()
+        ATable = jtree.calculate_variable_probability('A')
+
+        # Same result as a propagation where every clique sends its message
+        for clique in jtree.get_cliques_and_seps()[0]:
+            clique.received_evidence = True
+        jtree.sum_propagate()
+        self.assertAlmostEqual(jtree.calculate_variable_probability('A').get_prob(0), ATable.get_prob(0))
+
+        # Without new evidence nothing is absorbed
+        with mock.patch.object(JunctionTree, '_absorb', wraps=JunctionTree._absorb) as absorb:
+            jtree.sum_propagate()
+        self.assertEqual(absorb.call_count, 0)
+
+    def test_compile(self):
+        # The compiled tree must give the same results as the one built by hand
+        for build in [models.build_studfarm, models.build_chestclinic, models.build_poker]:
+            net, jtree = build()
+            jtree.initialize_tables(net)
+
+            for heuristic in ['min_fill', 'min_weight', 'min_degree']:
+                compiled = JunctionTree.compile(net, heuristic)
+                compiled.initialize_tables(net)
+
+                evidence_var = net.get_topological_order()[-1]
+                evidence_value = list(evidence_var.values)[0]
+                for tree in [jtree, compiled]:
+                    tree.add_evidence(evidence_var, evidence_value)
+                    tree.sum_propagate()
+
+                for var in net.get_variables():
+                    self.assertTrue(np.allclose(jtree.calculate_variable_probability(var).get_prob(slice(None)),
+                                                compiled.calculate_variable_probability(var).get_prob(slice(None))))
+                jtree.initialize_tables(net)
+
+        # Parts of the net that are not connected end up in different cliques
+        net = BayesianNet()
+        net.add_variable(self.S)
+        net.add_variable(self.H)
+        net.add_variable(self.D)
+        net.add_dependence('H', 'S')
+        net.add_prob_table('S', BeliefTable([self.S], np.array([0.9, 0.1])))
+        net.add_prob_table('H', BeliefTable([self.H, self.S], np.array([[0.8, 0.3], [0.2, 0.7]])))
+        net.add_prob_table('D', BeliefTable([self.D], np.array([0.6, 0.4])))
+
+        jtree = JunctionTree.compile(net)
+        self.assertEqual(len(jtree.get_cliques_and_seps()[0]), 2)
+        jtree.initialize_tables(net)
+        jtree.add_evidence('H', 0)
+        jtree.sum_propagate()
+
+        self.assertAlmostEqual(jtree.calculate_variable_probability('S').get_prob(0), 0.72 / 0.75)
+        self.assertAlmostEqual(jtree.calculate_variable_probability('D').get_prob(0), 0.6)
+
+    def test_optimize_triangulation(self):
+        net, jtree = models.build_studfarm()
+        graph = net.get_moral_graph()
+
+        for workers in [None, 2]:
+            result = triangulation.optimize_triangulation(net, restarts=3, workers=workers)
+            for heuristic in triangulation.HEURISTICS:
+                cliques, _ = triangulation.triangulate(graph, heuristic)
+                self.assertLessEqual(result.total_state_space, triangulation.get_total_state_space(cliques))
+            self.assertEqual(sum(result.get_histogram().values()), len(result.cliques))
+
+        # The result can populate a JunctionTree
+        compiled = JunctionTree([var for var in net.get_variables()])
+        for clique in result.cliques:
+            compiled.add_clique(clique)
+        for clique1, clique2 in result.connections:
+            compiled.connect_cliques(clique1, clique2)
+
+        compiled.initialize_tables(net)
+        jtree.initialize_tables(net)
+        for var in net.get_variables():
+            self.assertTrue(np.allclose(jtree.calculate_variable_probability(var).get_prob(slice(None)),
+                                        compiled.calculate_variable_probability(var).get_prob(slice(None))))
+
+        # The parts of a net that is not connected are linked by empty separators
+        net = BayesianNet()
+        net.add_variable(self.S)
+        net.add_variable(self.H)
+        net.add_variable(self.D)
+        net.add_dependence('H', 'S')
+        net.add_prob_table('S', BeliefTable([self.S], np.array([0.9, 0.1])))
+        net.add_prob_table('H', BeliefTable([self.H, self.S], np.array([[0.8, 0.3], [0.2, 0.7]])))
+        net.add_prob_table('D', BeliefTable([self.D], np.array([0.6, 0.4])))
+
+        result = triangulation.optimize_triangulation(net, restarts=2)
+        compiled = JunctionTree([var for var in net.get_variables()])
+        for clique in result.cliques:
+            compiled.add_clique(clique)
+        clique1, clique2 = result.connections[0]
+        self.assertRaises(AttributeError, compiled.connect_cliques, clique1, clique2)
+        for clique1, clique2 in result.connections:
+            compiled.connect_cliques(clique1, clique2, allow_empty=True)
+
+        compiled.initialize_tables(net)
+        compiled.add_evidence('H', 0)
+        compiled.sum_propagate()
+        self.assertAlmostEqual(compiled.calculate_variable_probability('S').get_prob(0), 0.72 / 0.75)
+        self.assertAlmostEqual(compiled.calculate_variable_probability('D').get_prob(0), 0.6)
+
+    def test_root_selection(self):
+        net, jtree = models.build_studfarm()
+        jtree.initialize_tables(net)
+        cliques, separators = jtree.get_cliques_and_seps()
+
+        costs = jtree.estimate_cost()
+        self.assertEqual(len(costs), len(cliques))
+
+        # The cheapest root is a smallest clique, the one with the shortest critical path is in the middle of the tree
+        cheapest = jtree.get_best_root('flops')
+        self.assertEqual(cheapest.get_prob_table().get_vars_size(), 8)
+        self.assertEqual(min(cost['flops'] for cost in costs.values()), costs[cheapest]['flops'])
+        self.assertIs(jtree.get_best_root('depth'), jtree.get_clique(['A', 'B', 'H', 'I']))
+
+        # Any root gives the same result
+        jtree.add_evidence('J', 'sick')
+        jtree.sum_propagate(criterion='depth')
+        expected = jtree.calculate_variable_probability('A').get_prob(0)
+        for root in cliques:
+            jtree.initialize_tables(net)
+            jtree.add_evidence('J', 'sick')
+            jtree.sum_propagate(root)
+            self.assertAlmostEqual(jtree.calculate_variable_probability('A').get_prob(0), expected)
+
+        # Separators that don't link two cliques yet are ignored
+        jtree.add_separator(['A', 'B', 'H'])
+        self.assertEqual(jtree.estimate_cost().keys(), costs.keys())
+        jtree.initialize_tables(net)
+        self.assertAlmostEqual(jtree.calculate_variable_probability('A').get_prob(0), 0.01)
+
+    def test_parallel_propagation(self):
+        net, jtree = models.build_studfarm()
+        root = jtree.get_clique(['A', 'B', 'H', 'I'])
+
+        # Levels are the schedule split by the depth of the children
+        levels = jtree.get_propagation_levels(root)
+        self.assertEqual([edge for level in levels for edge in level], list(jtree.get_propagation_schedule(root)))
+        self.assertTrue(all(edge[0] in [el[2] for el in levels[i - 1]] for i in range(1, len(levels))
+                            for edge in levels[i]))
+
+        jtree.initialize_tables(net)
+        jtree.add_evidence('J', 'sick')
+        jtree.sum_propagate(root)
+        expected = [jtree.calculate_variable_probability(name).get_prob(0) for name in 'ABCDEFGHIJKL']
+
+        jtree.initialize_tables(net)
+        jtree.add_evidence('J', 'sick')
+        jtree.sum_propagate(root, workers=4)
+        result = [jtree.calculate_variable_probability(name).get_prob(0) for name in 'ABCDEFGHIJKL']
+        np.testing.assert_allclose(result, expected)
+        self.assertFalse(any(clique.received_evidence for clique in jtree.get_cliques_and_seps()[0]))
+
+        # The thread pool is kept until the number of workers changes, and it's not saved
+        executor = jtree._executor
+        jtree.reset()
+        jtree.add_evidence('H', 'pure')
+        jtree.sum_propagate(root, workers=4)
+        self.assertIs(jtree._executor, executor)
+        jtree.reset()
+        jtree.add_evidence('H', 'pure')
+        jtree.sum_propagate(root, workers=2)
+        self.assertIsNot(jtree._executor, executor)
+        self.assertIsNone(pickle.loads(pickle.dumps(jtree))._executor)
+
+    def test_arena(self):
+        net, jtree = models.build_studfarm()
+        jtree.initialize_tables(net)
+        cliques, separators = jtree.get_cliques_and_seps()
+        tables = [node.get_prob_table() for node in cliques + separators]
+
+        # Every table is a view of the same buffer
+        self.assertEqual(sum(table.get_vars_size() for table in tables), jtree._arena.size)
+        self.assertTrue(all(np.shares_memory(table.get_prob(Ellipsis), jtree._arena) for table in tables))
+
+        # Propagation updates the tables in place
+        jtree.add_evidence('J', 'sick')
+        jtree.sum_propagate()
+        self.assertTrue(all(node.get_prob_table() is table for node, table in zip(cliques + separators, tables)))
+        self.assertAlmostEqual(np.sum(cliques[0].get_prob_table().get_prob(Ellipsis)), 1)
+
+        # Conflicting evidence leaves the tables as they were
+        arena = jtree._arena.copy()
+        self.assertRaises(RuntimeError, jtree.add_evidence, 'J', 'pure')
+        self.assertTrue(np.array_equal(jtree._arena, arena))
+
+        # The arena isn't saved, it's built again from the tables
+        copied = pickle.loads(pickle.dumps(jtree))
+        self.assertIsNone(copied._arena)
+        copied.add_evidence('A', 'carrier')
+        copied.sum_propagate()
+        self.assertAlmostEqual(np.sum(copied._arena[:cliques[0].get_prob_table().get_vars_size()]), 1)
+
+    def test_absorption_plans(self):
+        net, jtree = models.build_studfarm()
+        jtree.initialize_tables(net)
+        jtree.add_evidence('J', 'sick')
+        jtree.sum_propagate()
+        expected = [jtree.calculate_variable_probability(name).get_prob(Ellipsis).copy() for name in 'ABCDEFGHIJKL']
+
+        # Propagations use the plans of the edges instead of looking up the plans of the table operations
+        jtree.reset()
+        jtree.add_evidence('J', 'sick')
+        plan_cache.clear()
+        jtree.sum_propagate()
+        self.assertEqual(plan_cache.info()['hits'] + plan_cache.info()['misses'], 0)
+        for name, marginal in zip('ABCDEFGHIJKL', expected):
+            np.testing.assert_allclose(jtree.calculate_variable_probability(name).get_prob(Ellipsis), marginal)
+
+        # A table that is replaced gets a new plan
+        clique = jtree.get_clique(['A', 'B', 'H', 'I'])
+        separator = clique.get_neighbours()[0]
+        other = [el for el in separator.get_neighbours() if el is not clique][0]
+        plan = jtree._get_absorption_plan(other, separator, clique)
+        self.assertIs(jtree._get_absorption_plan(other, separator, clique), plan)
+
+        table = clique.get_prob_table()
+        clique.set_prob_table(BeliefTable(list(table.get_variables()), table.get_prob(Ellipsis).copy()))
+        self.assertIsNot(jtree._get_absorption_plan(other, separator, clique), plan)
+
+    def test_reset(self):
+        net, jtree = models.build_studfarm()
+        self.assertRaises(AttributeError, jtree.reset)
+
+        jtree.initialize_tables(net)
+        prior = jtree.calculate_variable_probability('A').get_prob(Ellipsis).copy()
+
+        jtree.add_evidence('J', 'sick')
+        snapshot = jtree.snapshot()
+        jtree.sum_propagate()
+        posterior = jtree.calculate_variable_probability('A').get_prob(Ellipsis).copy()
+        self.assertFalse(np.allclose(prior, posterior))
+
+        # Restoring brings back the evidence that wasn't propagated yet
+        jtree.restore(snapshot)
+        jtree.sum_propagate()
+        np.testing.assert_array_equal(jtree.calculate_variable_probability('A').get_prob(Ellipsis), posterior)
+
+        jtree.reset()
+        np.testing.assert_array_equal(jtree.calculate_variable_probability('A').get_prob(Ellipsis), prior)
+        self.assertFalse(any(clique.received_evidence for clique in jtree.get_cliques_and_seps()[0]))
+
+        # Snapshots can't be used once the tree changed
+        jtree.add_clique(['A', 'B'])
+        self.assertRaises(AttributeError, jtree.restore, snapshot)
+        self.assertRaises(AttributeError, jtree.reset)
+
+    def test_evidence_retraction(self):
+        net, jtree = models.build_studfarm()
+
+        def get_marginals(evidence):
+            jtree.initialize_tables(net)
+            for name, value in evidence.items():
+                jtree.add_evidence(name, value)
+            jtree.sum_propagate()
+            return [jtree.calculate_variable_probability(name).get_prob(Ellipsis).copy() for name in 'ABCDEFGHIJKL']
+
+        only_j = get_marginals({'J': 'sick'})
+        changed_a = get_marginals({'J': 'sick', 'A': 'pure'})
+
+        jtree.initialize_tables(net)
+        jtree.add_evidence('J', 'sick')
+        jtree.add_evidence('A', 'carrier')
+        jtree.sum_propagate()
+        self.assertEqual(jtree.get_evidence(), {'J': 'sick', 'A': 'carrier'})
+
+        jtree.change_evidence('A', 'pure')
+        self.assertEqual(jtree.get_evidence(), {'J': 'sick', 'A': 'pure'})
+        for name, expected in zip('ABCDEFGHIJKL', changed_a):
+            np.testing.assert_allclose(jtree.calculate_variable_probability(name).get_prob(Ellipsis), expected)
+
+        jtree.retract_evidence('A')
+        self.assertEqual(jtree.get_evidence(), {'J': 'sick'})
+        for name, expected in zip('ABCDEFGHIJKL', only_j):
+            np.testing.assert_allclose(jtree.calculate_variable_probability(name).get_prob(Ellipsis), expected)
+
+        self.assertRaises(AttributeError, jtree.retract_evidence, 'A')
+        self.assertRaises(AttributeError, jtree.change_evidence, 'A', 'unknown')
+
+        jtree.reset()
+        self.assertEqual(jtree.get_evidence(), {})
+
+    def test_likelihood_evidence(self):
+        net, jtree = models.build_studfarm()
+        jtree.initialize_tables(net)
+        prior = jtree.calculate_variable_probability('A').get_prob(Ellipsis).copy()
+
+        # The posterior of the observed variable is proportional to prior times likelihood
+        jtree.add_likelihood('A', [0.8, 0.2])
+        jtree.sum_propagate()
+        expected = prior * [0.8, 0.2] / np.dot(prior, [0.8, 0.2])
+        np.testing.assert_allclose(jtree.calculate_variable_probability('A').get_prob(Ellipsis), expected)
+        self.assertEqual(jtree.get_evidence(), {'A': [0.8, 0.2]})
+
+        # Hard evidence is the 0/1 likelihood
+        jtree.reset()
+        jtree.add_likelihood('J', [1, 0, 0])
+        jtree.sum_propagate()
+        soft = jtree.calculate_variable_probability('C').get_prob(Ellipsis).copy()
+        self.assertEqual(jtree.get_evidence(), {'J': 'sick'})
+        jtree.reset()
+        jtree.add_evidence('J', 'sick')
+        jtree.sum_propagate()
+        np.testing.assert_array_equal(jtree.calculate_variable_probability('C').get_prob(Ellipsis), soft)
+
+        self.assertRaises(AttributeError, jtree.add_likelihood, 'A', [1, 0, 0])
+        self.assertRaises(AttributeError, jtree.add_likelihood, 'A', [-1, 2])
+        self.assertRaises(RuntimeError, jtree.add_likelihood, 'J', [0, 1, 1])
+
+    def test_bulk_evidence(self):
+        net, jtree = models.build_studfarm()
+        jtree.initialize_tables(net)
+
+        jtree.add_evidence('J', 'sick')
+        jtree.add_evidence('A', 'carrier')
+        jtree.add_likelihood('L', [0.3, 0.7])
+        jtree.sum_propagate()
+        expected = [jtree.calculate_variable_probability(name).get_prob(Ellipsis).copy() for name in 'ABCDEFGHIJKL']
+        evidence_prob = jtree.get_evidence_probability()
+
+        jtree.reset()
+        self.assertEqual(jtree.get_evidence_probability(), 1)
+        jtree.set_evidence({'J': 'sick', 'A': 'carrier', 'L': [0.3, 0.7]})
+        self.assertAlmostEqual(jtree.get_evidence_probability(), evidence_prob)
+        for name, marginal in zip('ABCDEFGHIJKL', expected):
+            np.testing.assert_allclose(jtree.calculate_variable_probability(name).get_prob(Ellipsis), marginal)
+        self.assertEqual(jtree.get_evidence(), {'J': 'sick', 'A': 'carrier', 'L': [0.3, 0.7]})
+
+        # Conflicts are found both in a single clique and across cliques, the tree is left unchanged
+        arena = jtree._arena.copy()
+        self.assertRaises(RuntimeError, jtree.set_evidence, {'J': 'pure'})
+        self.assertRaises(RuntimeError, jtree.set_evidence, {'H': 'pure', 'B': 'carrier'})
+        np.testing.assert_allclose(jtree._arena, arena)
+        self.assertEqual(jtree.get_evidence(), {'J': 'sick', 'A': 'carrier', 'L': [0.3, 0.7]})
+        self.assertAlmostEqual(jtree.get_evidence_probability(), evidence_prob)
+
+    def test_query(self):
+        net, jtree = models.build_studfarm()
+        jtree.initialize_tables(net)
+        jtree.add_evidence('J', 'sick')
+        jtree.add_likelihood('D', [0.4, 0.6])
+        jtree.sum_propagate()
+        expected = {name: jtree.calculate_variable_probability(name).get_prob(Ellipsis).copy() for name in 'ABCDEFGHIJKL'}
+
+        # Only the absorptions toward the queried clique are executed
+        jtree.reset()
+        jtree.add_evidence('J', 'sick')
+        jtree.add_likelihood('D', [0.4, 0.6])
+        with mock.patch.object(JunctionTree, '_absorb', wraps=JunctionTree._absorb) as absorb:
+            marginal = jtree.query('A')
+            self.assertLess(absorb.call_count, len(jtree.get_cliques_and_seps()[1]))
+        np.testing.assert_allclose(marginal.get_prob(Ellipsis), expected['A'])
+
+        # The following queries and the next propagation use what was already collected
+        for name in 'BCDEFGHIJKL':
+            np.testing.assert_allclose(jtree.query(name).get_prob(Ellipsis), expected[name])
+        jtree.sum_propagate()
+        for name in 'ABCDEFGHIJKL':
+            np.testing.assert_allclose(jtree.calculate_variable_probability(name).get_prob(Ellipsis), expected[name])
+
+    def test_posterior_cache(self):
+        net, jtree = models.build_studfarm()
+        replica = pickle.loads(pickle.dumps(jtree))
+        cache = PosteriorCache()
+        self.assertRaises(AttributeError, cache.query, jtree, {}, ['A'])
+
+        jtree.initialize_tables(net)
+        replica.initialize_tables(net)
+        self.assertEqual(jtree.get_model_id(), replica.get_model_id())
+
+        first = cache.query(jtree, {'J': 'sick', 'A': 'Pure'}, ['B', 'C'])
+        jtree.set_evidence({'H': 'carrier'})
+
+        # Same evidence in a different order, on a copy of the model, without propagating
+        with mock.patch.object(JunctionTree, 'sum_propagate') as propagate:
+            second = cache.query(replica, {'A': 'pure', 'J': 'sick'}, ['C', 'B'])
+            propagate.assert_not_called()
+        self.assertEqual(list(second), ['C', 'B'])
+        np.testing.assert_array_equal(first['B'].get_prob(Ellipsis), second['B'].get_prob(Ellipsis))
+
+        info = cache.info()
+        self.assertEqual((info['hits'], info['misses'], info['hit_rate'], info['size']), (1, 1, 0.5, 1))
+        self.assertEqual(info['bytes'], 32)
+
+        # Least recently used results are evicted to stay in the budget
+        small_cache = PosteriorCache(max_bytes=40)
+        small_cache.query(jtree, {}, ['A', 'B'])
+        small_cache.query(jtree, {'J': 'sick'}, ['A'])
+        self.assertEqual((small_cache.info()['evictions'], small_cache.info()['bytes']), (1, 16))
+
+        # Changing the model drops its results once no tree has it anymore
+        variable = next(el for el in net.get_variables() if len(net.get_fathers(el)) == 0)
+        net.add_prob_table(variable, BeliefTable([variable], np.array([0.5, 0.5])))
+        jtree.initialize_tables(net)
+        self.assertNotEqual(jtree.get_model_id(), replica.get_model_id())
+        cache.query(jtree, {}, ['B'])
+        self.assertEqual(cache.info()['size'], 2)
+        replica.initialize_tables(net)
+        cache.query(replica, {}, ['B'])
+        self.assertEqual(cache.info()['size'], 1)
+        self.assertEqual(cache.info()['hits'], 2)
+
     def test_bnet_linking(self):
         # Test if it's possible to calculate the probability of a variable given the bayesian net
         # No message passing, single cluster
@@ -420,6 +1073,228 @@ class JunctionTreeTest(unittest.TestCase):
         self.assertAlmostEqual(round(HTable.get_prob(0), 4), 0)
         self.assertAlmostEqual(round(HTable.get_prob(1), 4), 1)
 
+
+class BatchJunctionTreeTest(unittest.TestCase):
+
+    def test_batch_inference(self):
+        net, jtree = models.build_studfarm()
+        jtree.initialize_tables(net)
+        prior_j = jtree.calculate_variable_probability('J').get_prob(Ellipsis).copy()
+
+        cases = [{'J': 'sick'}, {}, {'J': 'sick', 'A': 'pure', 'L': [0.3, 0.7]}, {'H': 'pure', 'J': 'sick'},
+                 {'A': 'carrier', 'K': 'pure'}]
+
+        # Cases are propagated two at a time
+        batch = BatchJunctionTree(jtree, batch_size=2)
+        with warnings.catch_warnings():
+            warnings.simplefilter('error')
+            result = batch.infer(cases)
+        self.assertEqual(result['A'].shape, (5, 2))
+        self.assertAlmostEqual(batch.get_evidence_probability()[0], prior_j[0])
+        self.assertAlmostEqual(batch.get_evidence_probability()[1], 1)
+
+        # Conflicting evidence gives NaN and P(e)=0
+        self.assertEqual(batch.get_evidence_probability()[3], 0)
+        self.assertTrue(np.all(np.isnan(result['B'][3])))
+
+        for i in [0, 1, 2, 4]:
+            jtree.reset()
+            if len(cases[i]) != 0:
+                jtree.set_evidence(cases[i])
+            for name in 'ABCDEFGHIJKL':
+                np.testing.assert_allclose(result[name][i], jtree.calculate_variable_probability(name).get_prob(Ellipsis))
+
+        # Evidence given as likelihood arrays
+        likelihoods = {'J': np.array([[1., 0., 0.], [0., 0., 1.]])}
+        result = batch.infer_likelihoods(likelihoods, ['A'])
+        self.assertEqual(list(result), ['A'])
+        np.testing.assert_allclose(result['A'][0], batch.infer([{'J': 'sick'}])['A'][0])
+
+        self.assertRaises(AttributeError, batch.infer_likelihoods, {'J': np.ones((2, 2))})
+        self.assertRaises(AttributeError, batch.infer, [{'J': 'unknown'}])
+
+    def test_batch_infer(self):
+        net, jtree = models.build_studfarm()
+        cases = [{'J': 'sick'}, {}, {'H': 'pure', 'J': 'sick'}, {'A': 'carrier', 'L': [0.3, 0.7]}] * 3
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'studfarm.dat')
+            util.serialize_model(net, jtree, path)
+
+            expected = list(batch_infer(path, cases, ['A', 'J'], workers=1, batch_size=5))
+            result = list(batch_infer(path, cases, ['A', 'J'], workers=2, batch_size=5))
+
+            # Cases are read only a few chunks ahead of the results
+            read = []
+
+            def read_cases():
+                for i in range(1000):
+                    read.append(i)
+                    yield cases[i % len(cases)]
+
+            results = batch_infer(path, read_cases(), ['A'], workers=2, batch_size=5)
+            next(results)
+            self.assertLessEqual(len(read), 5 * 5)
+            results.close()
+
+        self.assertEqual(len(result), len(cases))
+        for (marginals, evidence_prob), (expected_marginals, expected_prob) in zip(result, expected):
+            self.assertEqual(list(marginals), ['A', 'J'])
+            np.testing.assert_array_equal(marginals['A'], expected_marginals['A'])
+            self.assertEqual(evidence_prob, expected_prob)
+        self.assertEqual(result[2][1], 0)
+
+
+class CommandLineTest(unittest.TestCase):
+
+    def test_infer(self):
+        net, jtree = models.build_studfarm()
+        lines = ['{"id": 1, "evidence": {"J": "sick"}, "query": ["A"]}', '', '{"evidence": {"H": "pure", "J": "sick"}}',
+                 '{"evidence": {"X": 1}}', 'not json', '{"evidence": {"L": [0.3, 0.7]}}', '{"query": 5}',
+                 '{"evidence": {"J": {"x": 1}}}']
+        output = io.StringIO()
+
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'studfarm.dat')
+            util.serialize_model(net, jtree, path)
+            errors = bnjt.infer(path, io.StringIO('\n'.join(lines)), output, ['A', 'J'])
+
+        results = [json.loads(line) for line in output.getvalue().splitlines()]
+        self.assertEqual(len(results), 7)
+        self.assertEqual(errors, 4)
+
+        jtree.initialize_tables(net)
+        jtree.add_evidence('J', 'sick')
+        jtree.sum_propagate()
+        self.assertEqual(results[0]['id'], 1)
+        self.assertEqual(list(results[0]['marginals']), ['A'])
+        self.assertAlmostEqual(results[0]['marginals']['A']['carrier'],
+                               jtree.calculate_variable_probability('A').get_prob(0))
+        self.assertAlmostEqual(results[0]['evidence_probability'], jtree.get_evidence_probability())
+
+        self.assertEqual(results[1]['evidence_probability'], 0)
+        self.assertIn('error', results[1])
+        self.assertIn('error', results[2])
+        self.assertIn('error', results[3])
+
+        # Each case starts from the tables without evidence
+        self.assertEqual(list(results[4]['marginals']), ['A', 'J'])
+        self.assertAlmostEqual(sum(results[4]['marginals']['J'].values()), 1)
+
+        # Malformed cases don't stop the stream
+        self.assertIn('error', results[5])
+        self.assertIn('error', results[6])
+
+
+class InferenceServerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.net, jtree = models.build_studfarm()
+        self.directory = tempfile.TemporaryDirectory()
+        path = os.path.join(self.directory.name, 'studfarm.dat')
+        util.serialize_model(self.net, jtree, path)
+
+        self.server = InferenceServer({'studfarm': path}, replicas=2, workers=2, session_timeout=1, acquire_timeout=0.2)
+        self.loop = asyncio.new_event_loop()
+        self.port = self.loop.run_until_complete(self.server.start('127.0.0.1', 0))
+        self.thread = threading.Thread(target=self.loop.run_forever)
+        self.thread.start()
+
+    def tearDown(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.thread.join()
+        self.loop.run_until_complete(self.server.close())
+        self.loop.close()
+        self.directory.cleanup()
+
+    def request(self, connection, method, path, body=None):
+        connection.request(method, path, None if body is None else json.dumps(body))
+        response = connection.getresponse()
+        return response.status, json.loads(response.read())
+
+    def test_requests(self):
+        connection = http.client.HTTPConnection('127.0.0.1', self.port, timeout=10)
+
+        _, jtree = util.load_model(os.path.join(self.directory.name, 'studfarm.dat'))
+        jtree.initialize_tables(self.net)
+        jtree.set_evidence({'J': 'sick', 'A': 'pure'})
+
+        status, result = self.request(connection, 'POST', '/infer',
+                                      {'model': 'studfarm', 'evidence': {'J': 'sick', 'A': 'pure'}, 'query': ['B']})
+        self.assertEqual(status, 200)
+        self.assertAlmostEqual(result['marginals']['B']['carrier'],
+                               jtree.calculate_variable_probability('B').get_prob(0))
+        self.assertAlmostEqual(result['evidence_probability'], jtree.get_evidence_probability())
+
+        # Sessions keep their evidence and their replica until they're closed
+        status, result = self.request(connection, 'POST', '/sessions', {'model': 'studfarm'})
+        session = '/sessions/' + result['session']
+        self.request(connection, 'POST', session + '/evidence', {'evidence': {'J': 'sick'}})
+        status, result = self.request(connection, 'POST', session + '/evidence', {'evidence': {'A': 'pure'}})
+        self.assertAlmostEqual(result['marginals']['B']['carrier'],
+                               jtree.calculate_variable_probability('B').get_prob(0))
+        self.assertEqual(self.request(connection, 'GET', '/models')[1]['studfarm']['available'], 1)
+
+        status, result = self.request(connection, 'POST', session + '/evidence', {'evidence': {'H': 'pure'}})
+        self.assertEqual(status, 409)
+        self.assertEqual(self.request(connection, 'DELETE', session)[0], 200)
+        self.assertEqual(self.request(connection, 'POST', session + '/reset')[0], 404)
+
+        self.assertEqual(self.request(connection, 'POST', '/infer', {'model': 'other'})[0], 404)
+        self.assertEqual(self.request(connection, 'POST', '/infer', {'model': 'studfarm', 'query': ['X']})[0], 400)
+
+        status, stats = self.request(connection, 'GET', '/stats')
+        self.assertEqual(stats['replicas']['studfarm'], {'total': 2, 'available': 2})
+        self.assertEqual(stats['queue_depth'], 0)
+        self.assertEqual(stats['errors'], 4)
+        self.assertGreater(stats['latency_ms']['p99'], 0)
+        connection.close()
+
+    def test_session_lifetime(self):
+        connection = http.client.HTTPConnection('127.0.0.1', self.port, timeout=10)
+        session = '/sessions/' + self.request(connection, 'POST', '/sessions', {'model': 'studfarm'})[1]['session']
+
+        # Closing a session waits for the request that is using its replica
+        started = threading.Event()
+        proceed = threading.Event()
+
+        def blocking_request(*args):
+            started.set()
+            proceed.wait(10)
+            return run_request(*args)
+
+        def send(method, path, body, statuses):
+            other = http.client.HTTPConnection('127.0.0.1', self.port, timeout=10)
+            statuses.append(self.request(other, method, path, body)[0])
+            other.close()
+
+        run_request = server._run_request
+        statuses = []
+        with mock.patch('server._run_request', side_effect=blocking_request):
+            evidence = threading.Thread(target=send, args=('POST', session + '/evidence', {'evidence': {}}, statuses))
+            evidence.start()
+            started.wait(10)
+            delete = threading.Thread(target=send, args=('DELETE', session, None, statuses))
+            delete.start()
+            time.sleep(0.1)
+            self.assertEqual(self.request(connection, 'GET', '/models')[1]['studfarm']['available'], 1)
+            proceed.set()
+            evidence.join()
+            delete.join()
+        self.assertEqual(statuses, [200, 200])
+        self.assertEqual(self.request(connection, 'GET', '/models')[1]['studfarm']['available'], 2)
+
+        # Requests that can't get a replica in time fail, idle sessions are closed
+        sessions = [self.request(connection, 'POST', '/sessions', {'model': 'studfarm'})[1]['session']
+                    for _ in range(2)]
+        self.assertEqual(self.request(connection, 'POST', '/infer', {'model': 'studfarm'})[0], 503)
+        time.sleep(1.6)
+        self.assertEqual(self.request(connection, 'POST', '/infer', {'model': 'studfarm'})[0], 200)
+        self.assertEqual(self.request(connection, 'POST', '/sessions/' + sessions[0] + '/reset')[0], 404)
+        self.assertEqual(self.request(connection, 'GET', '/stats')[1]['sessions'], 0)
+        connection.close()
+
+
 if __name__ == '__main__':
     unittest.main()
 
@@ -0,0 +1,315 @@
+#
+# This file contains the functions used to build the junction tree of a bayesian net: the moral graph is triangulated
+# by eliminating its variables one at a time, the maximal cliques of the triangulated graph are extracted and then
+# connected in a tree. It also contains a search for the elimination order that gives the smallest tables
+#
+import random
+import time
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import TimeoutError
+from concurrent.futures import as_completed
+
+HEURISTICS = ('min_fill', 'min_weight', 'min_degree')
+
+
+def get_elimination_cost(graph, variable, heuristic):
+    """
+    Returns the cost of eliminating a variable from the graph according to the given heuristic:
+    -'min_fill': number of links that have to be added between the neighbours of the variable
+    -'min_degree': number of neighbours of the variable
+    -'min_weight': size of the table of the clique made up of the variable and its neighbours
+
+    :param graph: undirected graph, each variable is mapped to the set of its neighbours
+    :type graph: dict[Variable,set[Variable]]
+    :type variable: Variable
+    :type heuristic: str
+    :rtype: int
+    """
+    neighbours = graph[variable]
+
+    if heuristic == 'min_fill':
+        fill = 0
+        for el in neighbours:
+            fill += len(neighbours - graph[el]) - 1
+        return fill // 2
+    elif heuristic == 'min_degree':
+        return len(neighbours)
+    elif heuristic == 'min_weight':
+        weight = variable.get_cardinality()
+        for el in neighbours:
+            weight *= el.get_cardinality()
+        return weight
+
+    raise AttributeError("Unknown heuristic: " + str(heuristic))
+
+
+def find_elimination_order(graph, heuristic='min_fill', rng=None):
+    """
+    Greedily builds an elimination order for the graph, at each step the variable with the lowest cost according to
+    the heuristic is eliminated. Ties are broken by the order of the variables in the graph, or randomly if a random
+    generator is given
+
+    :param graph: undirected graph, each variable is mapped to the set of its neighbours
+    :type graph: dict[Variable,set[Variable]]
+    :type heuristic: str
+    :type rng: random.Random
+    :rtype: list[Variable]
+    """
+    graph = {var: set(neighbours) for var, neighbours in graph.items()}
+    order = []
+
+    while len(graph) != 0:
+        best_cost = None
+        best_vars = []
+        for var in graph:
+            cost = get_elimination_cost(graph, var, heuristic)
+            if best_cost is None or cost < best_cost:
+                best_cost = cost
+                best_vars = [var]
+            elif cost == best_cost:
+                best_vars.append(var)
+
+        chosen = best_vars[0] if rng is None else rng.choice(best_vars)
+        _eliminate_variable(graph, chosen)
+        order.append(chosen)
+
+    return order
+
+
+def _eliminate_variable(graph, variable):
+    """
+    Removes a variable from the graph after linking all of its neighbours to each other
+
+    :type graph: dict[Variable,set[Variable]]
+    :type variable: Variable
+    :return: the clique made up of the variable and its neighbours
+    :rtype: set[Variable]
+    """
+    neighbours = graph.pop(variable)
+    for el in neighbours:
+        graph[el] |= neighbours
+        graph[el].discard(el)
+        graph[el].discard(variable)
+
+    return neighbours | {variable}
+
+
+def get_cliques(graph, order):
+    """
+    Triangulates the graph by eliminating its variables in the given order and returns the maximal cliques of the
+    triangulated graph, in elimination order
+
+    :type graph: dict[Variable,set[Variable]]
+    :type order: list[Variable]
+    :rtype: list[set[Variable]]
+    """
+    graph = {var: set(neighbours) for var, neighbours in graph.items()}
+    if len(order) != len(graph) or set(order) != graph.keys():
+        raise AttributeError("The elimination order must contain each variable of the graph once")
+
+    cliques = []
+    for var in order:
+        clique = _eliminate_variable(graph, var)
+
+        # A clique created later can't contain one created before it without being the same clique, so only the
+        # cliques already found have to be checked
+        if not any(clique <= el for el in cliques):
+            cliques.append(clique)
+
+    return cliques
+
+
+def get_clique_connections(cliques):
+    """
+    Connects the cliques in a tree by finding the maximum weight spanning tree(Kruskal) of the graph where the weight of
+    a link is the number of variables the two cliques have in common. Cliques without common variables are only
+    connected if the graph of the bayesian net is not connected.
+    Returns pairs of indexes of cliques
+
+    :type cliques: list[set[Variable]]
+    :rtype: list[tuple[int,int]]
+    """
+    candidates = []
+    for i in range(len(cliques)):
+        for j in range(i + 1, len(cliques)):
+            candidates.append((len(cliques[i] & cliques[j]), i, j))
+
+    # Heavier links first, the stable sort keeps the elimination order for ties
+    candidates.sort(key=lambda el: -el[0])
+
+    # Union-find structure to know which cliques are already connected
+    roots = list(range(len(cliques)))
+
+    def find(i):
+        while roots[i] != i:
+            roots[i] = roots[roots[i]]
+            i = roots[i]
+        return i
+
+    connections = []
+    for _, i, j in candidates:
+        root_i = find(i)
+        root_j = find(j)
+        if root_i != root_j:
+            roots[root_i] = root_j
+            connections.append((i, j))
+
+    return connections
+
+
+def triangulate(graph, heuristic='min_fill', order=None):
+    """
+    Finds the cliques of the junction tree of the given moral graph and their connections, in a form that can be
+    passed to JunctionTree.add_clique and JunctionTree.connect_cliques: a list of cliques, each a list of variables, and
+    a list of pairs of cliques. If the graph is not connected, the pairs that link its parts have no common variables
+    and must be passed to connect_cliques with allow_empty=True
+
+    :param graph: undirected graph, each variable is mapped to the set of its neighbours
+    :type graph: dict[Variable,set[Variable]]
+    :param heuristic: used to find the elimination order if it's not given
+    :type heuristic: str
+    :type order: list[Variable]
+    :rtype: tuple[list[list[Variable]],list[tuple[list[Variable],list[Variable]]]]
+    """
+    if order is None:
+        order = find_elimination_order(graph, heuristic)
+
+    cliques = get_cliques(graph, order)
+    connections = get_clique_connections(cliques)
+
+    clique_lists = [sorted(clique) for clique in cliques]
+    return clique_lists, [(clique_lists[i], clique_lists[j]) for i, j in connections]
+
+
+def get_total_state_space(cliques):
+    """
+    Returns the total number of entries of the tables of the given cliques
+
+    :type cliques: list[set[Variable]] or list[list[Variable]]
+    :rtype: int
+    """
+    total = 0
+    for clique in cliques:
+        size = 1
+        for el in clique:
+            size *= el.get_cardinality()
+        total += size
+
+    return total
+
+
+class TriangulationResult(object):
+    """
+    Outcome of a triangulation: the elimination order, the cliques and connections to pass to
+    JunctionTree.add_clique/connect_cliques(with allow_empty=True if the net is not connected) and the size of the
+    tables
+    """
+
+    def __init__(self, order, cliques, connections, heuristic, seed=None):
+        """
+        :type order: list[Variable]
+        :type cliques: list[list[Variable]]
+        :type connections: list[tuple[list[Variable],list[Variable]]]
+        :param heuristic: heuristic that found the order
+        :type heuristic: str
+        :param seed: seed of the random tie-breaking, None if ties were broken by the order of the variables
+        :type seed: int
+        """
+        self.order = order
+        self.cliques = cliques
+        self.connections = connections
+        self.heuristic = heuristic
+        self.seed = seed
+
+        """
+        Total number of entries of the clique tables
+        """
+        self.total_state_space = get_total_state_space(cliques)
+
+    def get_histogram(self):
+        """
+        Returns how many cliques there are for each clique size(number of variables)
+
+        :rtype: dict[int,int]
+        """
+        return dict(sorted(Counter(len(clique) for clique in self.cliques).items()))
+
+    def __str__(self):
+        rstring = 'Heuristic: ' + self.heuristic
+        if self.seed is not None:
+            rstring += ' (seed ' + str(self.seed) + ')'
+        rstring += '\nTotal state space: ' + str(self.total_state_space) + '\nClique sizes:\n'
+        for size, count in self.get_histogram().items():
+            rstring += '\t' + str(size) + ' variables: ' + str(count) + '\n'
+
+        return rstring[:-1]
+
+
+def _run_trial(graph, heuristic, seed):
+    """
+    Finds an elimination order with the given heuristic and returns it with the total state space of its cliques.
+    It's a module level function so that it can be run by worker processes
+
+    :type graph: dict[Variable,set[Variable]]
+    :type heuristic: str
+    :param seed: seed of the random tie-breaking, None to break ties by the order of the variables
+    :type seed: int
+    :rtype: tuple[int,str,int,list[Variable]]
+    """
+    rng = None if seed is None else random.Random(seed)
+    order = find_elimination_order(graph, heuristic, rng)
+
+    return get_total_state_space(get_cliques(graph, order)), heuristic, seed, order
+
+
+def optimize_triangulation(bayes_net, heuristics=HEURISTICS, restarts=10, time_budget=None, workers=None, seed=0):
+    """
+    Searches for the elimination order of the moral graph of the net whose cliques have the smallest total state
+    space. Each heuristic is tried once with ties broken by the order of the variables and then restarts times with
+    random tie-breaking.
+
+    :type bayes_net: BayesianNet
+    :type heuristics: tuple[str] or list[str]
+    :param restarts: number of randomized runs for each heuristic
+    :type restarts: int
+    :param time_budget: seconds after which no new run is started, None for no limit
+    :type time_budget: float
+    :param workers: number of worker processes, None or 1 to run everything in this process
+    :type workers: int
+    :param seed: seed of the random generator that gives the seed of each run
+    :type seed: int
+    :rtype: TriangulationResult
+    """
+    graph = bayes_net.get_moral_graph()
+
+    seeds = random.Random(seed)
+    trials = [(heuristic, None) for heuristic in heuristics]
+    trials += [(heuristic, seeds.randrange(2 ** 32)) for _ in range(restarts) for heuristic in heuristics]
+
+    start = time.monotonic()
+    results = []
+    if workers is None or workers <= 1:
+        for heuristic, trial_seed in trials:
+            # At least one run is always completed
+            if time_budget is not None and len(results) > 0 and time.monotonic() - start > time_budget:
+                break
+            results.append(_run_trial(graph, heuristic, trial_seed))
+    else:
+        executor = ProcessPoolExecutor(max_workers=workers)
+        futures = [executor.submit(_run_trial, graph, heuristic, trial_seed) for heuristic, trial_seed in trials]
+        try:
+            for future in as_completed(futures, timeout=time_budget):
+                results.append(future.result())
+        except TimeoutError:
+            if len(results) == 0:
+                results.append(futures[0].result())
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    # Ties go to the run that was planned first
+    trial_positions = {(heuristic, trial_seed): i for i, (heuristic, trial_seed) in enumerate(trials)}
+    _, heuristic, trial_seed, order = min(results, key=lambda el: (el[0], trial_positions[(el[1], el[2])]))
+
+    cliques, connections = triangulate(graph, heuristic, order)
+    return TriangulationResult(order, cliques, connections, heuristic, trial_seed)